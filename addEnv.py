@@ -2,31 +2,76 @@
 Find all dirs containing any specified file types, and add these dirs to an environment variable.
 The default mode finds all exe files' dirs and add them as %CUSTOM%, so you won't need to manually add CLI programs to PATH.
 Alternatively, you can use '-r' to generate a registry file (.reg) so as to share with different machines.
-Only works on Windows.
+Modifying the environment only works on Windows, while scanning, '-r' and '-l' work anywhere.
 '''
 
-import os; assert os.name == 'nt'
-import sys; assert sys.version_info >= (3, 6)
+import os
+import sys; assert sys.version_info >= (3, 9)
+import json
 import argparse
+from fnmatch import fnmatch
 from pathlib import Path
-from operator import methodcaller
-from winreg import ConnectRegistry, OpenKey, QueryValueEx, SetValueEx, HKEY_CURRENT_USER, KEY_ALL_ACCESS
+from concurrent.futures import ThreadPoolExecutor
+try:
+    from winreg import ConnectRegistry, OpenKey, QueryValueEx, SetValueEx, HKEY_CURRENT_USER, KEY_ALL_ACCESS
+except ImportError:
+    ConnectRegistry = None # not on Windows
 
 DEFAULT_SUFFIX = ['.exe']
+SCAN_JOBS = 16 # the number of threads reading dirs in parallel
+CACHE_PATH = Path(__file__).with_name(Path(__file__).stem + '_cache.json')
+# each scanned dir is cached by its resolved path with its mtime, which changes when an entry is added/removed/renamed
+# in the dir, so later runs only read the dirs changed since, though every dir is still stat-ed once
 
 
-def addPath(path: Path, suffix: list[str]) -> list[Path]:
+def scanDir(path: str, suffix: list[str], exclude: list[str], cache: dict) -> tuple:
+    # return the id of the dir (to detect link loops) and [mtime, whether it holds any file with `suffix`, subdirs]
+    # the entry types come with the dir read, so no entry is stat-ed unless it is a link, which is resolved
+    try:
+        st = os.stat(path)
+        if (hit := cache.get(path)) and hit[0] == st.st_mtime_ns:
+            return (st.st_dev, st.st_ino), hit
+        found, subdirs = False, []
+        with os.scandir(path) as it:
+            for entry in it:
+                if entry.is_dir():
+                    if not any(fnmatch(entry.name, p) or fnmatch(entry.path, p) for p in exclude):
+                        subdirs.append(os.path.realpath(entry.path) if entry.is_symlink() else entry.path)
+                elif not found and entry.is_file() and os.path.splitext(entry.name)[1].lower() in suffix:
+                    found = True
+        return (st.st_dev, st.st_ino), [st.st_mtime_ns, found, subdirs]
+    except OSError: # e.g. no permission, or removed during the scan
+        return None, None
+
+
+def addPath(path: Path, suffix: list[str], exclude: list[str] = None, cache: dict = None, update: dict = None,
+            jobs: int = SCAN_JOBS) -> list[Path]:
+    # find the dirs under `path` holding any file with `suffix`, reading the dirs of each level in parallel
+    # the dirs matching any `exclude` pattern (by name or path) are pruned with everything under them
+    # `cache` is consulted by dir mtime, and the result of every dir scanned is written to `update` if given
+    exclude = exclude or []
+    cache = cache or {}
     ret = []
     if path.is_file() and (path.suffix.lower() in suffix):
         ret += [path.parent.resolve()]
     elif path.is_dir():
-        items = tuple(path.iterdir())
-        for f in filter(methodcaller('is_file'), items):
-            if f.suffix.lower() in suffix:
-                ret += [path.resolve()]
-                break
-        for d in filter(methodcaller('is_dir'), items):
-            ret += addPath(d, suffix)
+        level, seen = [str(path.resolve())], set()    # so every dir below is keyed by its resolved path
+        with ThreadPoolExecutor(jobs) as executor:
+            while level:
+                size = -(-len(level) // jobs) # a slice of the level per thread, as a task per dir costs more than a read
+                results = executor.map(lambda ds: [scanDir(d, suffix, exclude, cache) for d in ds],
+                                       (level[i:i+size] for i in range(0, len(level), size)))
+                next_level = []
+                for d, (key, res) in zip(level, (r for rs in results for r in rs)):
+                    if not res or key in seen:
+                        continue
+                    seen.add(key)
+                    if update is not None:
+                        update[d] = res
+                    if res[1]:
+                        ret += [Path(d)]
+                    next_level += res[2]
+                level = next_level
     return ret
 
 
@@ -37,10 +82,25 @@ def Main(args):
     else:
         args.suffix = [s.lower() for s in args.suffix]
 
+    cache = {}
+    config = {'suffix': sorted(args.suffix), 'exclude': sorted(args.exclude)} # the cache is invalid if these change
+    if args.cache and CACHE_PATH.is_file() and (saved := json.loads(CACHE_PATH.read_bytes())).get('config') == config:
+        cache = saved['dirs']
+    update = {}
+
     paths = []
     for path in map(Path, args.paths):
-        paths += addPath(path, args.suffix)
+        paths += addPath(path, args.suffix, args.exclude, cache, update, args.jobs)
+    if args.cache: # keep the cached dirs outside the scanned paths, and drop those under them but no longer found
+        roots = [str(p.resolve()) for p in map(Path, args.paths) if p.is_dir()]
+        dirs = {d: res for d, res in cache.items()
+                if not any(d == r or d.startswith(os.path.join(r, '')) for r in roots)} | update
+        CACHE_PATH.write_text(json.dumps({'config': config, 'dirs': dirs}), encoding='utf-8')
     paths += list(map(Path, args.manual_paths))
+
+    if args.list:
+        print(*sorted(paths), sep='\n')
+        return
     paths = ';'.join(str(p) for p in sorted(paths))
 
     if args.out_registry:
@@ -52,6 +112,7 @@ def Main(args):
         Path(f'{args.varname}.reg').write_bytes(b'\xff\xfe' + entry.encode('utf-16-le'))
         input(f'Saved paths to \'{args.varname}.reg\'.')
     else:
+        assert ConnectRegistry, "Modifying the environment only works on Windows, use '-r' or '-l' instead."
         with ConnectRegistry(None, HKEY_CURRENT_USER) as reg:
             with OpenKey(reg, 'Environment', access=KEY_ALL_ACCESS) as env: # Admin not required
                 try:
@@ -90,6 +151,15 @@ if __name__ == '__main__':
                         help='manually ADD these paths to `var`', metavar='add')
     parser.add_argument('-r', '--registry', dest='out_registry', action='store_true', default=False,
                         help='generate a registry file instead of modifying environment now')
+    parser.add_argument('-x', '--exclude', dest='exclude', type=str, action='extend', nargs='*', default=[],
+                        help='skip the dirs (and everything under) whose name or path matches these patterns',
+                        metavar='pattern')
+    parser.add_argument('-j', '--jobs', dest='jobs', type=int, default=SCAN_JOBS,
+                        help=f'the number of threads to scan dirs (default={SCAN_JOBS})', metavar='n')
+    parser.add_argument('-l', '--list', dest='list', action='store_true', default=False,
+                        help='only print the found dirs')
+    parser.add_argument('--no-cache', dest='cache', action='store_false', default=True,
+                        help='rescan every dir instead of only those changed since the last run')
     parser.add_argument('-y', '--yes', dest='prompt', action='store_false', default=True,
                         help="don't prompt on overwritting")
     Main(parser.parse_args())
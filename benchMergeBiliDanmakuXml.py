@@ -0,0 +1,272 @@
+# coding=utf-8
+
+from __future__ import annotations
+
+try:
+    import sys
+    assert sys.version_info >= (3, 8)
+
+    import json
+    import random
+    import shutil
+    import argparse
+    import tempfile
+    from pathlib import Path
+    from time import perf_counter
+    from operator import attrgetter
+    from datetime import datetime, timedelta as td
+    from binascii import crc32
+    from concurrent.futures import ProcessPoolExecutor
+    from xml.sax.saxutils import escape, quoteattr
+
+    import mergeBiliDanmakuXml as mbdx                                          # the script to benchmark, alongside
+except AssertionError:
+    input('Please use Python 3.8 or above')
+    exit()
+except ImportError:
+    input('Please put this script alongside mergeBiliDanmakuXml.py and check its dependency')
+    exit()
+
+'''=====================================================================================================================
+CONFIGURABLE PARAMETERS
+====================================================================================================================='''
+
+BENCH_SIZES = [1000, 100000]
+# the number of danmaku sent in each synthetic live to benchmark, unless given in the command line
+# the live is recorded by 3 overlapping recordings, so the inputs hold about twice as many danmaku in total
+
+BENCH_DURATION = 4 * 3600
+BENCH_SKEW = 3.0
+BENCH_DRIFT_TOLERANCE = 1.0
+# the length of the synthetic live in seconds, so larger lives are denser rather than longer
+# and the clock skew of the recording from https://matsuri.icu in seconds
+# a run fails if the estimated drifts miss the skew by more than BENCH_DRIFT_TOLERANCE sec, or are not found at all
+
+BENCH_CORPUS_PATH = Path(__file__).stem + '_corpus'
+# the generated recordings are kept in this dir (alongside the script by default) and reused by later runs
+
+BENCH_REPEAT = 3
+# each size is benchmarked this many times and the fastest time of each stage is kept, to reduce the noise
+
+BENCH_BASELINE_PATH = Path(__file__).stem + '_baseline.json'
+BENCH_TOLERANCE = 0.25
+BENCH_MIN_TIME = 0.1
+# a run fails if any stage is this much slower than the baseline of the same size, or uses this much more memory
+# stages taking less than BENCH_MIN_TIME sec are not checked, since their time is mostly noise
+# use '--save-baseline' to store the results as the new baseline, which is only meaningful on the same machine
+
+
+'''=====================================================================================================================
+AUTO-DETERMINED PARAMETERS
+====================================================================================================================='''
+
+STAGES = ('parse', 'match', 'serialize', 'id_table')
+POPULAR_TEXTS = ['草', '?', '？？？', 'hhh', '哈哈哈哈', '好耶', 'awsl', '来了', '888', '晚上好', '<3', '&']
+ROOM_ID = '1321846'
+ROOM_NAME = '夏诺雅_shanoa'
+
+
+'''=====================================================================================================================
+HELPER FUNCTIONS
+====================================================================================================================='''
+
+def generate(out_dir:Path, n:int, seed:int=0) -> list[Path]:
+    # write 3 overlapping recordings of a synthetic live of `n` danmaku in the order to merge, return their paths
+    # 'a' is a modern BiliRec recording with record info, covering the first 60% of the live
+    # 'b' is a legacy BiliRec recording without record info, covering the last 50% of the live
+    # 'c' is from https://matsuri.icu with crc32 uids and timestamps in sec, starting 95 sec early and skewed
+    rng = random.Random(seed)
+    st = datetime(2021, 2, 16, 13, 0, 51, tzinfo=mbdx.TIME_ZONE)
+    users = [(str(rng.randint(1, 10**9)), f'用户{i}') for i in range(max(10, n // 20))]
+    specs = [ # (filename, start sec, end sec, keep ratio, flavour)
+        (f'录制-{ROOM_ID}-{st:%Y%m%d-%H%M%S}-a.xml', 0, 0.6 * BENCH_DURATION, 0.95, 'modern'),
+        (f'录制-{ROOM_ID}-{st + td(seconds=BENCH_DURATION // 2):%Y%m%d-%H%M%S}-b.xml',
+         BENCH_DURATION // 2, BENCH_DURATION, 0.95, 'legacy'),
+        (f'{ROOM_NAME}_x_{int((st.timestamp() - 95) * 1000)}.xml', -95, BENCH_DURATION, 0.9, 'matsuri')]
+
+    out_dir.mkdir(parents=True, exist_ok=True)
+    paths = [out_dir.joinpath(spec[0]) for spec in specs]
+    fos = [path.open('w', encoding='utf-8', newline='\n') for path in paths]
+    for fo, (_, start, _, _, flavour) in zip(fos, specs):
+        fo.write('<?xml version="1.0" encoding="utf-8"?>\n<i>\n')
+        if flavour == 'modern':
+            fo.write(f'<BililiveRecorderRecordInfo roomid="{ROOM_ID}" name="{ROOM_NAME}" '
+                     f'start_time="{(st + td(seconds=start)).isoformat()}" />\n')
+
+    t = 0.0
+    for k in range(n):
+        t += rng.expovariate(n / BENCH_DURATION)                    # a poisson process, so the danmaku are in order
+        uid, user = users[int(len(users) * rng.random() ** 3)]      # a few users send most danmaku
+        r = rng.random()
+        if r < 0.93:
+            kind = 'd'
+            text = rng.choice(POPULAR_TEXTS) if rng.random() < 0.3 else f'弹幕{int(n / 4 * rng.random() ** 2)}'
+            pos, colour = rng.choice('1114'), rng.choice(['16777215', '16777215', '5566168'])
+        elif r < 0.97:
+            kind, giftname, count = 'gift', rng.choice(['小心心', '辣条', '打call']), rng.randint(1, 10)
+        elif r < 0.99:
+            kind, text, price = 'sc', f'醒目留言{k}', rng.choice([30, 50, 100])
+        else:
+            kind, level = 'guard', rng.choice([1, 2, 3, 3, 3])
+        for fo, (_, start, end, keep, flavour) in zip(fos, specs):
+            if not start <= t < end or rng.random() >= keep or (flavour == 'matsuri' and kind == 'guard'):
+                continue
+            ts = max(0.0, t - start + rng.uniform(-0.3, 0.3) + (BENCH_SKEW if flavour == 'matsuri' else 0.0))
+            if kind == 'd' and flavour == 'matsuri':
+                fo.write(f'<d p="{ts:.3f},1,25,16777215,{int(st.timestamp() + t)},0,{crc32(uid.encode()):x},0">'
+                         f'{escape(text)}</d>\n')
+            elif kind == 'd':
+                fo.write(f'<d p="{ts:.3f},{pos},25,{colour},{int((st.timestamp() + t) * 1000)},0,{uid},0" '
+                         f'user={quoteattr(user)}>{escape(text)}</d>\n')
+            elif kind == 'gift':
+                fo.write(f'<gift ts="{ts:.3f}" user={quoteattr(user)} uid="{uid}" giftname="{giftname}" '
+                         f'giftcount="{count}" />\n')
+            elif kind == 'sc':
+                fo.write(f'<sc ts="{ts:.3f}" user={quoteattr(user)} uid="{uid}" price="{price}" time="60">'
+                         f'{escape(text)}</sc>\n')
+            else:
+                fo.write(f'<guard ts="{ts:.3f}" user={quoteattr(user)} uid="{uid}" level="{level}" count="1" />\n')
+    for fo in fos:
+        fo.write('</i>')
+        fo.close()
+    return paths
+
+
+def benchSize(paths:list[Path]) -> dict:
+    # time each stage of merging the recordings, run in a fresh process so that the peak RSS is for this size only
+    # the stages use a temporary ID_TABLE and no RECORD_CACHE, so nothing outside the temporary dir is touched
+    ret = {}
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        mbdx.ID_TABLE = id_table = mbdx.IdTable(Path(tmp_dir).joinpath('crc2uid.db'))
+
+        t0 = perf_counter()
+        records = [mbdx.DanmakuRecord(path) for path in paths]
+        ret['parse'] = [perf_counter() - t0, n := sum(map(len, records))]
+
+        t0 = perf_counter()
+        rid, name, st = mbdx.recordInfo(records)
+        offsets = [(r.st - st).total_seconds() for r in records]
+        drifts = mbdx.estimateDrifts(records, offsets)
+        offsets = [offset + (drift or 0.0) for offset, drift in zip(offsets, drifts)]
+        out = mbdx.matchRecords(records, offsets, drifts, progress=False)
+        ret['match'] = [perf_counter() - t0, n]
+        ret['drifts'] = drifts
+
+        t0 = perf_counter()
+        mbdx.writeDanmakuXml(Path(tmp_dir).joinpath('merged.xml'), sorted(out, key=attrgetter('ts')), rid, name, st)
+        ret['serialize'] = [perf_counter() - t0, len(out)]
+
+        t0 = perf_counter()
+        num = len(id_table.updates)                                 # learnt while matching
+        id_table.flush()
+        mbdx.ID_TABLE = mbdx.IdTable(id_table.path)                 # look up from the db rather than the cache
+        for record in records:
+            num += sum(not user for user in record.danmaku_lst[0].user)
+            record.lookup()
+        ret['id_table'] = [perf_counter() - t0, num]
+        mbdx.ID_TABLE.db.close()
+        id_table.db.close()
+    ret['peak_rss'] = mbdx.peakRss()
+    return ret
+
+
+def checkDrifts(results:dict) -> list[str]:
+    # compare the estimated drifts with the skews of the synthetic recordings, return the misses
+    # a missed drift silently falls back to matching within TIME_TOLERANCE, which is slower and merges worse
+    ret = []
+    for size, result in results.items():
+        for drift, skew, name in zip(result['drifts'], (0.0, 0.0, -BENCH_SKEW), 'abc'):
+            if drift is None or abs(drift - skew) > BENCH_DRIFT_TOLERANCE:
+                ret.append(f'{size} drift: {drift} of \'{name}\' is not within {BENCH_DRIFT_TOLERANCE} sec of {skew}')
+    return ret
+
+
+def check(results:dict, baseline:dict) -> list[str]:
+    # compare the results with the baseline of the same size, return the regressions
+    ret = []
+    for size, result in results.items():
+        if not (base := baseline.get(size)):
+            continue
+        for stage in STAGES:
+            speed, old = (result[stage][1] / result[stage][0]), (base[stage][1] / base[stage][0])
+            if result[stage][0] >= BENCH_MIN_TIME and speed < old * (1 - BENCH_TOLERANCE):
+                ret.append(f'{size} {stage}: {speed:,.0f}/s is slower than the baseline {old:,.0f}/s')
+        if base.get('peak_rss') and result['peak_rss'] > base['peak_rss'] * (1 + BENCH_TOLERANCE):
+            ret.append(f'{size} peak_rss: {result["peak_rss"] / 2**20:,.1f} MiB is more than the baseline '
+                       f'{base["peak_rss"] / 2**20:,.1f} MiB')
+    return ret
+
+
+'''=====================================================================================================================
+MAIN
+====================================================================================================================='''
+
+def main(args):
+
+    if args.generate:
+        for n in args.sizes:
+            print(*generate(args.generate.joinpath(str(n)), n, args.seed), sep='\n')
+        return
+
+    results = {}
+    corpus_dir = Path(__file__).parent.joinpath(BENCH_CORPUS_PATH)
+    for n in args.sizes:
+        if (size_dir := corpus_dir.joinpath(f'{n}_{args.seed}')).is_dir():
+            paths = sorted(size_dir.glob('*.xml'), key=lambda p: (not p.name.startswith('录制'), p.name))
+        else:
+            paths = generate(size_dir.with_suffix('.tmp'), n, args.seed)
+            shutil.rmtree(size_dir, ignore_errors=True)
+            size_dir.with_suffix('.tmp').rename(size_dir)           # only keep a completely generated corpus
+            paths = [size_dir.joinpath(path.name) for path in paths]
+        for _ in range(BENCH_REPEAT):
+            with ProcessPoolExecutor(1) as executor:
+                run = executor.submit(benchSize, paths).result()
+            if (result := results.setdefault(str(n), run)) is not run:
+                result.update({stage: min(result[stage], run[stage]) for stage in STAGES})
+                result['peak_rss'] = min(result['peak_rss'], run['peak_rss'])
+        for stage in STAGES:
+            secs, num = result[stage]
+            print(f'{n:>12,} {stage:<10} {secs:10.3f} s {num:>12,} {num / max(secs, 1e-9):>14,.0f} /s')
+        print(f'{n:>12,} {"peak_rss":<10} {result["peak_rss"] / 2**20:10.1f} MiB')
+        print(f'{n:>12,} {"drifts":<10} ' + ' '.join('None' if d is None else f'{d:+.3f}' for d in result['drifts']))
+
+    baseline_path = Path(__file__).parent.joinpath(BENCH_BASELINE_PATH)
+    baseline = json.loads(baseline_path.read_bytes()) if baseline_path.is_file() else {}
+    regressions = checkDrifts(results)                              # checked even when saving the baseline
+    if args.save_baseline:
+        baseline.update(results)
+        baseline_path.write_text(json.dumps(baseline, indent=2), encoding='utf-8')
+    else:
+        regressions += check(results, baseline)
+    if regressions:
+        print(*regressions, sep='\n')
+        sys.exit(1)
+
+
+'''=====================================================================================================================
+CLI Interface
+====================================================================================================================='''
+
+class _CustomHelpFormatter(argparse.HelpFormatter):
+
+    def __init__(self, prog):
+        super().__init__(prog, max_help_position=50, width=100)
+
+    def _format_action_invocation(self, action):
+        if not action.option_strings or action.nargs == 0:
+            return super()._format_action_invocation(action)
+        default = self._get_default_metavar_for_optional(action)
+        args_string = self._format_args(action, default)
+        return ', '.join(action.option_strings) + ' ' + args_string
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(prog='bench', formatter_class=lambda prog: _CustomHelpFormatter(prog))
+    parser.add_argument('sizes', type=int, nargs='*', default=BENCH_SIZES,
+                        help=f'the numbers of danmaku in the synthetic lives (default={BENCH_SIZES})', metavar='n')
+    parser.add_argument('-s', '--seed', dest='seed', type=int, default=0,
+                        help='the random seed of the synthetic lives (default=0)', metavar='n')
+    parser.add_argument('-g', '--generate', dest='generate', type=Path,
+                        help='only generate the recordings into this dir, one sub dir per size', metavar='path')
+    parser.add_argument('--save-baseline', dest='save_baseline', action='store_true', default=False,
+                        help=f'store the results as the baseline in \'{BENCH_BASELINE_PATH}\' instead of checking them')
+    main(parser.parse_args())
@@ -6,26 +6,63 @@ try:
     import sys
     assert sys.version_info >= (3, 8)
 
+    import os
     import re
     import json
+    import pickle
+    import sqlite3
+    import cProfile
     import argparse
     from pathlib import Path
-    from functools import partial
     from operator import methodcaller, attrgetter, itemgetter
     from datetime import datetime, timedelta as td
+    from sys import intern
+    from array import array
     from binascii import crc32
+    from hashlib import blake2b
+    from functools import lru_cache, partial
+    from bisect import bisect_right
+    from heapq import heappush, heappop, merge as heapmerge
+    from itertools import chain
+    from collections import deque
+    from contextlib import nullcontext, contextmanager
+    from concurrent.futures import ProcessPoolExecutor
+    from typing import Iterable, Iterator
+    from time import sleep, perf_counter
+    from xml.parsers import expat
+    from xml.etree.ElementTree import iterparse, ParseError
+    from xml.sax.saxutils import escape, quoteattr
 
     from tqdm import tqdm                                                       # pip install tqdm
     from dateutil.parser import isoparse                                        # pip install python-dateutil
     from dateutil.tz import tzlocal
-    from bs4 import BeautifulSoup as BS, Tag as TAG, NavigableString as NS      # pip install beautifulsoup4
 except AssertionError:
     input('Please use Python 3.8 or above')
     exit()
 except ImportError:
-    input('Please check Python version (3.8+) and dependency (tqdm, dateutil and beautifulsoup4)')
+    input('Please check Python version (3.8+) and dependency (tqdm and dateutil)')
     exit()
 
+try:
+    from bs4 import BeautifulSoup as BS                                         # pip install beautifulsoup4 lxml
+except ImportError:
+    BS = None                                                                   # optional, only to salvage malformed xml
+
+try:
+    import numpy as np                                                          # pip install numpy
+except ImportError:
+    np = None                                                                   # optional, only to estimate clock drift
+
+try:
+    import resource                                                             # not available on Windows
+except ImportError:
+    resource = None
+
+try:
+    import psutil                                                               # pip install psutil
+except ImportError:
+    psutil = None                                                               # optional, only for peak RSS on Windows
+
 '''=====================================================================================================================
 CONFIGURABLE PARAMETERS
 ====================================================================================================================='''
@@ -34,26 +71,68 @@ TIME_TOLERANCE = 120
 # a pair of messages from two recordings will be merged if sent by the same user and within this interval
 # use 120 since https://matsuri.icu records danmaku ~100 sec ahead of actual live start, otherwise 10 is OK
 
+MATCH_TOLERANCE = 5
+DRIFT_BIN = 1.0
+DRIFT_HASH_BUCKETS = 4096
+DRIFT_TEXTS_PER_BUCKET = 256
+DRIFT_MIN_PEAK = 20
+DRIFT_MIN_SCORE = 10
+# if numpy is available, the clock drift between recordings is estimated before merging
+# by cross-correlating their danmaku binned by (text hash, DRIFT_BIN seconds) within TIME_TOLERANCE
+# the texts are hashed into about DRIFT_TEXTS_PER_BUCKET distinct texts per bucket, up to DRIFT_HASH_BUCKETS buckets
+# the drift is only trusted if the correlation peak is at least DRIFT_MIN_PEAK danmaku above the median correlation
+# and at least DRIFT_MIN_SCORE times the median absolute deviation, so that a dense background cannot hide it
+# after correcting the drift, a pair of messages only needs to be within MATCH_TOLERANCE to be merged
+
 TIME_ZONE = tzlocal()
 # the time zone
 
-ID_TABLE_PATH = Path(__file__).stem  + '_crc2uid.json'
+ID_TABLE_PATH = Path(__file__).stem  + '_crc2uid.db'
 READ_ID_TABLE = True
 UPDATE_ID_TABLE = True
 WRITE_ID_TABLE = True
 # danmaku downloaded from https://matsuri.icu removes text style and replaces user id with its crc32
 # if you locally use Bili-Rec (which saves style and id), this script can store the mapping from crc32 to the true id
 # here you can set the filename to save the mapping (alongside the script by default), and whether to use it
+# the mapping is a sqlite db, so entries are looked up on demand and several runs can update it at the same time
+# a mapping saved as '*_crc2uid.json' by earlier versions is imported when the db is created
+
+ID_TABLE_BATCH_SIZE = 10000
+# the number of updates buffered before they are written to the db
 
 BILIREC_FILENAME_PATTERN = r'录制-(?P<room_id>[0-9]+)-(?P<date>20[0-9]{6})-(?P<time>[0-9]{6})-.*'
 MATSURI_FILENAME_PATTERN = r'.*_(?P<millisec>1[0-9]{12})'
 
+RECORD_CACHE_PATH = Path(__file__).stem + '_cache'
+RECORD_CACHE_SIZE = 2 * 1024 ** 3
+# parsed recordings are cached in this dir (alongside the script by default) so that re-merging skips the xml parsing
+# a file is recognised by its path, size and mtime, or by its content if these changed, e.g. when moved or copied
+# the least recently used records are removed once the cache exceeds RECORD_CACHE_SIZE bytes
+# use '--no-cache' to bypass the cache and '--clear-cache' to empty it
+
+STREAM_REORDER = 10
+STREAM_CHUNK_SIZE = 1024
+# in streaming mode (-s), each input is read in a single pass and only the danmaku near the merge front are kept
+# the danmaku in an input are assumed to be in ts order, give or take STREAM_REORDER seconds
+# they are stored in chunks of STREAM_CHUNK_SIZE, which are freed once all their danmaku are written
+
+FOLLOW_INTERVAL = 60
+# in follow mode (--follow), the inputs may still be written by BiliRec, and are re-read for new danmaku periodically
+# the merged output is rewritten every FOLLOW_INTERVAL seconds (unless specified) until all inputs are complete
+# the read position of each input is saved alongside the output as '*.follow.json', so a restart resumes from there
+
+BATCH_STATE_PATH = Path(__file__).stem + '_batch.json'
+PROBE_SIZE = 65536
+# in batch mode (-b), the given dirs are scanned for recordings, which are grouped by live session and merged
+# a group is skipped if its output exists and its inputs are unchanged since the run recorded in BATCH_STATE_PATH
+# grouping only reads the first and last PROBE_SIZE bytes of each file
+
 
 '''=====================================================================================================================
 AUTO-DETERMINED PARAMETERS
 ====================================================================================================================='''
 
-ID_TABLE = json.loads(table.read_bytes()) if (table := Path(__file__).parent.joinpath(ID_TABLE_PATH)).is_file() else {}
+DANMAKU_TYPES = {'d': 0, 'sc': 1, 'gift': 2, 'guard': 3}  # the index of each type in DanmakuRecord.danmaku_lst
 XML_TEMPLATE = '''<?xml-stylesheet type="text/xsl" href="#s"?><i><chatserver>chat.bilibili.com</chatserver><chatid>0</chatid><mission>0</mission><maxlimit>1000</maxlimit><state>0</state><real_name>0</real_name><source>0</source><BililiveRecorder version="Not Applicable" /><BililiveRecorderXmlStyle><z:stylesheet version="1.0" id="s" xml:id="s" xmlns:z="http://www.w3.org/1999/XSL/Transform"><z:output method="html"/><z:template match="/"><html><meta name="viewport" content="width=device-width"/><title>B站录播姬弹幕文件 - <z:value-of select="/i/BililiveRecorderRecordInfo/@name"/></title><style>body{margin:0}h1,h2,p,table{margin-left:5px}table{border-spacing:0}td,th{border:1px solid grey;padding:1px}th{position:sticky;top:0;background:#4098de}tr:hover{background:#d9f4ff}div{overflow:auto;max-height:80vh;max-width:100vw;width:fit-content}</style><h1>B站录播姬弹幕XML文件</h1><p>本文件的弹幕信息兼容B站主站视频弹幕XML格式，可以使用现有的转换工具把文件中的弹幕转为ass字幕文件</p><table><tr><td>录播姬版本</td><td><z:value-of select="/i/BililiveRecorder/@version"/></td></tr><tr><td>房间号</td><td><z:value-of select="/i/BililiveRecorderRecordInfo/@roomid"/></td></tr><tr><td>主播名</td><td><z:value-of select="/i/BililiveRecorderRecordInfo/@name"/></td></tr><tr><td>录制开始时间</td><td><z:value-of select="/i/BililiveRecorderRecordInfo/@start_time"/></td></tr><tr><td><a href="#d">弹幕</a></td><td>共 <z:value-of select="count(/i/d)"/> 条记录</td></tr><tr><td><a href="#guard">上船</a></td><td>共 <z:value-of select="count(/i/guard)"/> 条记录</td></tr><tr><td><a href="#sc">SC</a></td><td>共 <z:value-of select="count(/i/sc)"/> 条记录</td></tr><tr><td><a href="#gift">礼物</a></td><td>共 <z:value-of select="count(/i/gift)"/> 条记录</td></tr></table><h2 id="d">弹幕</h2><div><table><tr><th>用户名</th><th>弹幕</th><th>参数</th></tr><z:for-each select="/i/d"><tr><td><z:value-of select="@user"/></td><td><z:value-of select="."/></td><td><z:value-of select="@p"/></td></tr></z:for-each></table></div><h2 id="guard">舰长购买</h2><div><table><tr><th>用户名</th><th>舰长等级</th><th>购买数量</th><th>出现时间</th></tr><z:for-each select="/i/guard"><tr><td><z:value-of select="@user"/></td><td><z:value-of select="@level"/></td><td><z:value-of select="@count"/></td><td><z:value-of select="@ts"/></td></tr></z:for-each></table></div><h2 id="sc">SuperChat 醒目留言</h2><div><table><tr><th>用户名</th><th>内容</th><th>显示时长</th><th>价格</th><th>出现时间</th></tr><z:for-each select="/i/sc"><tr><td><z:value-of select="@user"/></td><td><z:value-of select="."/></td><td><z:value-of select="@time"/></td><td><z:value-of select="@price"/></td><td><z:value-of select="@ts"/></td></tr></z:for-each></table></div><h2 id="gift">礼物</h2><div><table><tr><th>用户名</th><th>礼物名</th><th>礼物数量</th><th>出现时间</th></tr><z:for-each select="/i/gift"><tr><td><z:value-of select="@user"/></td><td><z:value-of select="@giftname"/></td><td><z:value-of select="@giftcount"/></td><td><z:value-of select="@ts"/></td></tr></z:for-each></table></div></html></z:template></z:stylesheet></BililiveRecorderXmlStyle></i>'''
 
 '''=====================================================================================================================
@@ -61,72 +140,194 @@ HELPER CLASSES
 ====================================================================================================================='''
 
 
-class Danmaku():
+class IdTable():
+    # the mapping from crc32 to [uid, user] in a sqlite db
+    # entries are looked up on demand and cached, while updates are buffered and upserted in batches
+    # the connection is opened lazily in each process, since a sqlite connection must not cross a fork
 
+    def __init__(self, path:Path) -> None:
+        self.path = path
+        self.pid = None
+        self.cache = {}                                             # entries looked up or updated by this process
+        self.updates = {}                                           # entries not yet written to the db
+        self.empty = None                                           # whether the db has no entry, checked once
+        self.counts = {'hit': 0, 'miss': 0, 'update': 0}            # for '--stats'
+
+    @property
+    def db(self) -> sqlite3.Connection:
+        if self.pid != os.getpid():
+            self.pid = os.getpid()
+            self._db = sqlite3.connect(self.path, timeout=60)       # wait for other writers rather than fail
+            self._db.execute('PRAGMA journal_mode=WAL')             # readers are not blocked by writers
+            with self._db:
+                self._db.execute('CREATE TABLE IF NOT EXISTS crc2uid '
+                                 '(crc TEXT PRIMARY KEY, uid TEXT NOT NULL, user TEXT NOT NULL) WITHOUT ROWID')
+                if (legacy := self.path.with_suffix('.json')).is_file() \
+                and not self._db.execute('SELECT 1 FROM crc2uid LIMIT 1').fetchone():
+                    self._db.executemany('INSERT OR IGNORE INTO crc2uid VALUES (?, ?, ?)',
+                                         ((k, *v) for k, v in json.loads(legacy.read_bytes()).items()))
+        return self._db
 
-    def __init__(self, tag:TAG, parent:DanmakuRecord=None) -> None:
-        # common attrs: type, text, ts
-        # for danmu: user, uid, pos, colour, millisec
-        # for others: attrs
-        self.parent = parent
-        if tag.name == 'd':
-            self.type = tag.name                            # danmaku type: 'd', 'gift', 'sc', 'guard'
-            self.text = tag.text                            # danmaku text
-            self.user = tag.get('user', '')                 # bilibili username (it may change)
-            self.ts = float((p := tag['p'].split(','))[0])  # TimeStamp in second relative to the start
-            self.pos = p[1]                                 # display postion: '1'=regular '4'=bottom
-            self.colour = p[3]                              # colour
-            if len(p[4]) == 13 and self.user:               # likely from local BiliRec
-                self.millisec = p[4]                        # absolute time in millisecond since epoch
-            elif len(p[4]) == 10 and parent:                           # likely from https://matsuri.icu
-                self.millisec = str(int((parent.st + td(seconds=self.ts)).timestamp() * 1000))
+    def get(self, crc:str) -> list[str]:
+        if crc not in self.cache:
+            row = self.db.execute('SELECT uid, user FROM crc2uid WHERE crc = ?', (crc,)).fetchone()
+            self.cache[crc] = list(row) if row else None
+        self.counts['hit' if self.cache[crc] else 'miss'] += 1
+        return self.cache[crc]
+
+    def __setitem__(self, crc:str, value:list[str]) -> None:
+        self.cache[crc] = self.updates[crc] = value
+        self.counts['update'] += 1
+        if len(self.updates) >= ID_TABLE_BATCH_SIZE:
+            self.flush()
+
+    def flush(self) -> None:
+        # upsert the buffered updates in a single transaction, unless WRITE_ID_TABLE is off
+        if WRITE_ID_TABLE and self.updates:
+            with self.db:
+                self.db.executemany('INSERT INTO crc2uid VALUES (?, ?, ?) ON CONFLICT(crc) DO UPDATE '
+                                    'SET uid = excluded.uid, user = excluded.user',
+                                    ((k, *v) for k, v in self.updates.items()))
+            self.updates.clear()
+            self.empty = False
+
+    def __bool__(self) -> bool:
+        # whether there is anything to look up, without creating the db only to find it empty
+        if self.empty is None:
+            self.empty = not (self.path.is_file() or self.path.with_suffix('.json').is_file()) \
+                      or not self.db.execute('SELECT 1 FROM crc2uid LIMIT 1').fetchone()
+        return bool(self.updates) or not self.empty
+
+
+ID_TABLE = IdTable(Path(__file__).parent.joinpath(ID_TABLE_PATH))
+
+
+class DanmakuList():
+    # all danmaku of one type in a record, stored by columns instead of as one object per danmaku
+    # common columns: text, ts
+    # for danmu: user, uid, pos, colour, millisec
+    # for others: attrs
+    __slots__ = ('type', 'text', 'ts', 'user', 'uid', 'pos', 'colour', 'millisec', 'attrs', 'merged')
+
+    def __init__(self, type:str) -> None:
+        self.type = type                                    # danmaku type: 'd', 'gift', 'sc', 'guard'
+        self.text = []                                      # danmaku text
+        self.ts = array('d')                                # TimeStamp in second relative to the start
+        self.merged = bytearray()                           # set if merged into a danmaku of an earlier record
+        if type == 'd':
+            self.user = []                                  # bilibili username (it may change)
+            self.uid = []
+            self.pos = []                                   # display postion: '1'=regular '4'=bottom
+            self.colour = []                                # colour
+            self.millisec = array('q')                      # absolute time in millisecond since epoch
+        else:
+            self.attrs = []                                 # other attributes as (key, value) pairs in the source order
+
+    def append(self, text:str, attrs:dict, st:datetime=None) -> None:
+        # all strings are interned as most of them (user, uid, colour, even text) are repeated many times
+        self.text.append(intern(text))
+        self.merged.append(0)
+        if self.type == 'd':
+            user = attrs.get('user', '')
+            self.ts.append(ts := float((p := attrs['p'].split(','))[0]))
+            self.pos.append(intern(p[1]))
+            self.colour.append(intern(p[3]))
+            if len(p[4]) == 13 and user:                    # likely from local BiliRec
+                self.millisec.append(int(p[4]))
+            elif len(p[4]) == 10 and st:                    # likely from https://matsuri.icu
+                self.millisec.append(int((st + td(seconds=ts)).timestamp() * 1000))
             elif len(p[4]) == 10:
-                self.millisec = f'{p[4]}{td(seconds=self.ts).microseconds // 1000:3d}'
+                self.millisec.append(int(p[4]) * 1000 + td(seconds=ts).microseconds // 1000)
+            elif len(p[4]) == 13:                           # a merged output with an unresolved matsuri uid
+                self.millisec.append(int(p[4]))
             else:
                 raise ValueError('Cannot determine danmaku absolute timestamp')
-            if READ_ID_TABLE and ID_TABLE and (not self.user):
-                self.uid, self.user = id if (id := ID_TABLE.get(p[6])) else (p[6], self.user)  # try lookup
-            else:                                           # otherwise, we are using local BiliRec or no ID_TABLE
-                self.uid =  p[6]                            # no need to lookup
+            self.uid.append(intern(p[6]))                   # crc32 of uid if from https://matsuri.icu, see lookup()
+            self.user.append(intern(user))
+        else:
+            self.ts.append(float((attrs := dict(attrs)).pop('ts')))
+            self.attrs.append(tuple((intern(k), intern(v)) for k, v in attrs.items()))
+
+    def lookup(self, start:int=0) -> None:
+        # replace the crc32 uid of danmaku without username (i.e. from https://matsuri.icu) by ID_TABLE if possible
+        # this is not done in append() so the cached records do not depend on ID_TABLE
+        if self.type == 'd' and READ_ID_TABLE and ID_TABLE:
+            for i in range(start, len(self)):
+                if not self.user[i] and (id := ID_TABLE.get(self.uid[i])):
+                    self.uid[i], self.user[i] = map(intern, id)
+
+    def match(self, i:int, obj:DanmakuList, j:int) -> bool:
+        # the rules of Danmaku.__eq__ between self[i] and obj[j] once type, text and ts are known to match
+        if self.type == 'd':
+            if (self.uid[i] == obj.uid[j]) or (self.user[i] == obj.user[j]):   # same uid/username
+                if self.colour[i] == '16777215': self.colour[i] = obj.colour[j]  # try updating colour from the other
+                if self.pos[i] == '1': self.pos[i] == obj.pos[j]                  # try updating pos from the other
+                return True
+            if self.uid[i] == uidcrc(obj.uid[j]):                               # self is from https://matsuri.icu
+                if UPDATE_ID_TABLE: ID_TABLE[self.uid[i]] = [obj.uid[j], obj.user[j]]
+                self.uid[i] = obj.uid[j]                                        # self should be updated
+                self.user[i] = obj.user[j]
+                self.colour[i] = obj.colour[j]
+                self.pos[i] = obj.pos[j]
+                self.millisec[i] = obj.millisec[j]
+                return True
+            if uidcrc(self.uid[i]) == obj.uid[j]:                               # obj is from https://matsuri.icu
+                if UPDATE_ID_TABLE: ID_TABLE[obj.uid[j]] = [self.uid[i], self.user[i]]
+                return True
         else:
-            self.type = tag.name
-            self.text = tag.text
-            self.ts = float((attrs := dict(tag.attrs)).pop('ts'))  # copy the dict to unbind BS object
-            self.attrs = attrs
+            if (a := self.attrs[i]) == (b := obj.attrs[j]) or sorted(a) == sorted(b):  # the order may differ
+                return True
+        return False
+
+    def __getitem__(self, i:int) -> Danmaku:
+        return Danmaku(self, i)
+
+    def __len__(self) -> int:
+        return len(self.ts)
+
+
+def _column(name:str) -> property:
+    return property(lambda self: getattr(self.lst, name)[self.i],
+                    lambda self, value: getattr(self.lst, name).__setitem__(self.i, value))
+
+
+class Danmaku():
+    # a view of a single danmaku in a DanmakuList, only created when an object is needed (e.g. for output)
+    __slots__ = ('lst', 'i')
+
+    text = _column('text')
+    ts = _column('ts')
+    user = _column('user')
+    uid = _column('uid')
+    pos = _column('pos')
+    colour = _column('colour')
+    millisec = _column('millisec')
+
+    def __init__(self, lst:DanmakuList, i:int) -> None:
+        self.lst = lst
+        self.i = i
 
     @property
-    def tag(self) -> TAG:
+    def type(self) -> str:
+        return self.lst.type
+
+    @property
+    def attrs(self) -> dict:
+        return dict(self.lst.attrs[self.i])
+
+    @property
+    def xml(self) -> str:
         if self.type == 'd':
-            ret = TAG(name='d', attrs={'p':f'{self.ts:.3f},{self.pos},25,{self.colour},{self.millisec},0,{self.uid},0'})
-            if self.text: ret.string = self.text
-            if self.user: ret['user'] = self.user
+            attrs = {'p':f'{self.ts:.3f},{self.pos},25,{self.colour},{self.millisec},0,{self.uid},0'}
+            if self.user: attrs['user'] = self.user
         else:
-            (attrs := self.attrs.copy())['ts'] = str(self.ts)
-            ret = TAG(name=self.type, attrs=attrs)
-            if self.text: ret.string = self.text
-        return ret
+            (attrs := self.attrs)['ts'] = str(self.ts)
+        attrs = ''.join(f' {k}={quoteattr(v)}' for k, v in attrs.items())
+        return f'<{self.type}{attrs}>{escape(self.text) if self.text else ""}</{self.type}>'
 
     def __eq__(self, obj: Danmaku) -> bool:
         if (self.type == obj.type) and (self.text == obj.text) and (abs(self.ts - obj.ts) < TIME_TOLERANCE):
-            if self.type == 'd':
-                if (self.uid == obj.uid) or (self.user == obj.user): # same uid/username
-                    if self.colour == '16777215': self.colour = obj.colour      # try updating colour from the other
-                    if self.pos == '1': self.pos == obj.pos                     # try updating pos from the other
-                    return True
-                if self.uid == f'{crc32(bytes(obj.uid, "utf-8")):x}':           # self is from https://matsuri.icu
-                    if UPDATE_ID_TABLE: ID_TABLE[self.uid] = [obj.uid, obj.user]
-                    self.uid = obj.uid                                          # self should be updated
-                    self.user = obj.user
-                    self.colour = obj.colour
-                    self.pos = obj.pos
-                    self.millisec = obj.millisec
-                    return True
-                if f'{crc32(bytes(self.uid, "utf-8")):x}' == obj.uid: # obj is from https://matsuri.icu
-                    if UPDATE_ID_TABLE: ID_TABLE[obj.uid] = [self.uid, self.user]
-                    return True
-            else:
-                if self.attrs == obj.attrs:
-                    return True
+            return self.lst.match(self.i, obj.lst, obj.i)
         return False
 
 
@@ -134,31 +335,50 @@ class DanmakuRecord():
 
     def __init__(self, path:Path) -> None:
         assert path.is_file() and path.suffix == '.xml'
-        soup = BS(path.read_bytes(), 'xml')
+        self.path = path
+        try:
+            self.parse(iterXmlTags(path))
+        except ParseError:
+            if not BS: raise
+            self.parse(iterSoupTags(path))                          # BS can recover from a broken/truncated file
+
+    def parse(self, tags:Iterable[tuple[str, str, dict]]) -> None:
+        self.rid = ''
+        self.name = ''
+        self.st = None
+        self.danmaku_lst = [*map(DanmakuList, DANMAKU_TYPES)]
+        for name, text, attrs in tags:
+            if name == 'BililiveRecorderRecordInfo':                # a latest BiliRec recording
+                self.setRecordInfo(attrs)
+            elif name in DANMAKU_TYPES:
+                if not self.st and name == 'd':                     # the record info always precedes the danmaku
+                    (d0 := DanmakuList('d')).append(text, attrs)    # only 'd' needs st to be parsed
+                    self.setStartTime(d0[0])
+                self.danmaku_lst[DANMAKU_TYPES[name]].append(text, attrs, self.st)
+        if not self.st:
+            self.setStartTime(None)
+
+    def setRecordInfo(self, attrs:dict) -> None:
+        self.rid = str(attrs.get('roomid', ''))
+        self.name = str(attrs.get('name', ''))
+        self.st = isoparse(attrs.get('start_time'))
 
-        if (rec_info := soup.find('BililiveRecorderRecordInfo')):       # a latest BiliRec recording
-            self.rid = str(rec_info.get('roomid', ''))
-            self.name = str(rec_info.get('name', ''))
-            self.st = isoparse(rec_info.get('start_time'))
-        elif (m := re.match(BILIREC_FILENAME_PATTERN, path.stem)):    # a legacy BiliRec recording
+    def setStartTime(self, d0:Danmaku) -> None:
+        # determine the start time from the filename if the recording has no record info
+        if (m := re.match(BILIREC_FILENAME_PATTERN, self.path.stem)):    # a legacy BiliRec recording
             self.rid = m['room_id']
-            self.name = ''
-            if (d := soup.find('d')):
-                self.st = datetime.fromtimestamp(int((d0 := Danmaku(d)).millisec)/1000.0 - float(d0.ts), TIME_ZONE)
+            if d0:
+                self.st = datetime.fromtimestamp(d0.millisec/1000.0 - d0.ts, TIME_ZONE)
             else:
-                self.st = isoparse(f"{m['date']}-{m['time']}")
-                self.st.replace(tzinfo=TIME_ZONE)
-        elif (m := re.match(MATSURI_FILENAME_PATTERN, path.stem)):    # downloaded from https://matsuri.icu
-            self.rid = ''
-            self.name = ''
+                self.st = isoparse(f"{m['date']}-{m['time']}").replace(tzinfo=TIME_ZONE)
+        elif (m := re.match(MATSURI_FILENAME_PATTERN, self.path.stem)):  # downloaded from https://matsuri.icu
             self.st = datetime.fromtimestamp(int(m['millisec'])/1000, TIME_ZONE)
         else:
-            raise ValueError(f'Cannot parse the start time from \'{path}\'')
+            raise ValueError(f'Cannot parse the start time from \'{self.path}\'')
 
-        self.danmaku_lst = [[*map(partial(Danmaku, parent=self), soup.find_all(name='d'))],
-                            [*map(partial(Danmaku, parent=self), soup.find_all(name='sc'))],
-                            [*map(partial(Danmaku, parent=self), soup.find_all(name='gift'))],
-                            [*map(partial(Danmaku, parent=self), soup.find_all(name='guard'))]]
+    def lookup(self) -> None:
+        for lst in self.danmaku_lst:
+            lst.lookup()
 
     def __len__(self) -> int:
         return sum(map(len, self.danmaku_lst))
@@ -167,52 +387,822 @@ class DanmakuRecord():
         return True
 
 
+class DanmakuStream(DanmakuRecord):
+    # a recording read lazily for the streaming merge, only its head is parsed on creation to find the start time
+    # iterating it yields views of its danmaku in ts order, as long as they are out of order by < STREAM_REORDER sec
+    # the rows are appended to small DanmakuLists, which are freed once all their views are dropped
+
+    def __init__(self, path:Path) -> None:
+        assert path.is_file() and path.suffix == '.xml'
+        self.path = path
+        self.rid = ''
+        self.name = ''
+        self.st = None
+        self.tags = iterXmlTags(path)
+        self.head = []                                              # the tags read ahead to find the start time
+        for name, text, attrs in self.tags:
+            self.head.append((name, text, attrs))
+            if name == 'BililiveRecorderRecordInfo':
+                self.setRecordInfo(attrs)
+                break
+            if name == 'd':
+                (d0 := DanmakuList('d')).append(text, attrs)
+                self.setStartTime(d0[0])
+                break
+        if not self.st:
+            self.setStartTime(None)
+
+    def __iter__(self) -> Iterator[Danmaku]:
+        lsts = {}
+        heap = []
+        for seq, (name, text, attrs) in enumerate(chain(self.head, self.tags)):
+            if name not in DANMAKU_TYPES:
+                continue
+            if name not in lsts or len(lsts[name]) >= STREAM_CHUNK_SIZE:
+                lsts[name] = DanmakuList(name)
+            (lst := lsts[name]).append(text, attrs, self.st)
+            lst.lookup(i := len(lst) - 1)
+            heappush(heap, (ts := lst.ts[i], seq, lst[i]))
+            while heap[0][0] < ts - STREAM_REORDER:
+                yield heappop(heap)[2]
+        while heap:
+            yield heappop(heap)[2]
+
+
+class FollowedRecord(DanmakuRecord):
+    # a recording that may still be written, read incrementally by an expat parser which accepts unfinished xml
+    # `offset` is the position right after the last complete child of the root, where reading can resume from
+    # the end of a child is only known once the next event is parsed, or found by tagEnd() at the end of a poll
+
+    def __init__(self, path:Path, checkpoint:dict=None) -> None:
+        assert path.is_file() and path.suffix == '.xml'
+        self.path = path
+        self.rid = ''
+        self.name = ''
+        self.st = None
+        self.offset = 0
+        self.end = None                                             # the start of the end tag of the last child
+        self.finished = False                                       # the root has been closed
+        self.pending = []                                           # complete children not yet turned into danmaku
+        self.danmaku_lst = []
+        self.lsts = {}                                              # the DanmakuLists being filled
+        self.parser = expat.ParserCreate()
+        self.parser.buffer_text = True
+        self.parser.StartElementHandler = self.onStart
+        self.parser.EndElementHandler = self.onEnd
+        self.parser.CharacterDataHandler = self.onText
+        self.depth = 0
+        if checkpoint:                                              # resume from the saved offset under a new root
+            self.rid, self.name, self.st = checkpoint['rid'], checkpoint['name'], isoparse(checkpoint['st'])
+            self.parser.Parse(prefix := b'<?xml version="1.0" encoding="utf-8"?><i>', False)
+            self.offset = checkpoint['offset']
+            self.base = self.offset - len(prefix)                   # file position = base + parser position
+        else:
+            self.base = 0
+        self.pos = self.offset                                      # the position to read from
+
+    @property
+    def checkpoint(self) -> dict:
+        return {'offset': self.offset, 'rid': self.rid, 'name': self.name, 'st': self.st.isoformat()}
+
+    def onStart(self, name:str, attrs:dict) -> None:
+        if (depth := self.depth) == 1:
+            self.offset = self.base + self.parser.CurrentByteIndex
+            self.end = None
+            self.elem = (name, [], attrs)
+        elif depth > 1 and self.elem[0] in DANMAKU_TYPES:
+            self.elem[1].append(' ')                                # danmaku should never have children anyway
+        self.depth += 1
+
+    def onEnd(self, name:str) -> None:
+        if (depth := self.depth - 1) == 1:
+            self.pending.append((self.elem[0], ''.join(self.elem[1]), self.elem[2]))
+            self.end = self.base + self.parser.CurrentByteIndex     # or the start of an empty element
+        elif depth == 0:
+            self.offset = self.base + self.parser.CurrentByteIndex
+            self.finished = True
+        self.depth = depth
+
+    def onText(self, text:str) -> None:
+        if self.depth == 1:
+            self.offset = self.base + self.parser.CurrentByteIndex
+            self.end = None
+        elif self.depth > 1:
+            self.elem[1].append(text)
+
+    def tagEnd(self, start:int) -> int:
+        # the position right after the tag at `start`, skipping any '>' in quoted attribute values
+        with self.path.open('rb') as fi:
+            fi.seek(start)
+            data = fi.read(self.pos - start)
+        quote = None
+        for k, c in enumerate(data):
+            if quote:
+                quote = None if c == quote else quote
+            elif c in b'"\'':
+                quote = c
+            elif c == ord('>'):
+                return start + k + 1
+        return start                                                # never happens as the tag has been parsed
+
+    def poll(self) -> list[Danmaku]:
+        # read what has been written since the last poll, return views of the new complete danmaku
+        if not self.finished:
+            with self.path.open('rb') as fi:
+                fi.seek(self.pos)
+                self.pos += len(data := fi.read())
+            self.parser.Parse(data, False)
+            if self.end is not None:                                # nothing parsed after the last child yet
+                self.offset = self.tagEnd(self.end)
+                self.end = None
+        for name, text, attrs in self.pending:
+            if name == 'BililiveRecorderRecordInfo':
+                self.setRecordInfo(attrs)
+            elif name == 'd' and not self.st:
+                (d0 := DanmakuList('d')).append(text, attrs)
+                self.setStartTime(d0[0])
+        if not self.st and self.finished:
+            self.setStartTime(None)
+        if not self.st:
+            return []                                               # wait for the head to know the start time
+        ret = []
+        for name, text, attrs in self.pending:
+            if name not in DANMAKU_TYPES:
+                continue
+            if name not in self.lsts or len(self.lsts[name]) >= STREAM_CHUNK_SIZE:
+                self.danmaku_lst.append(lst := DanmakuList(name))
+                self.lsts[name] = lst
+            (lst := self.lsts[name]).append(text, attrs, self.st)
+            lst.lookup(i := len(lst) - 1)
+            ret.append(lst[i])
+        self.pending.clear()
+        return ret
+
+
+class DanmakuPool():
+    # the merged danmaku so far in follow mode, grouped by (type, text) and sorted by ts like DanmakuIndex
+    # a new danmaku is merged into the earliest matching one from another recording, or otherwise added
+    # each kept danmaku absorbs at most one danmaku from each recording, tracked by a bit per recording in `srcs`
+
+    def __init__(self) -> None:
+        self.table = {}                                             # (type, text) -> ([ts], [index in danmaku])
+        self.danmaku = []
+        self.srcs = []
+
+    def add(self, r:int, d:Danmaku) -> bool:
+        tss, ks = self.table.setdefault((d.type, d.text), ([], []))
+        i = bisect_right(tss, (ts := d.ts) - TIME_TOLERANCE)
+        while i < len(tss) and tss[i] - ts < TIME_TOLERANCE:
+            e = self.danmaku[k := ks[i]]
+            if not self.srcs[k] >> r & 1 and abs(tss[i] - ts) < TIME_TOLERANCE and e.lst.match(e.i, d.lst, d.i):
+                self.srcs[k] |= 1 << r
+                return False
+            i += 1
+        self.keep(d, 1 << r)
+        return True
+
+    def keep(self, d:Danmaku, srcs:int) -> None:
+        # add `d` as merged from the recordings in `srcs` without matching, e.g. when restored from a checkpoint
+        tss, ks = self.table.setdefault((d.type, d.text), ([], []))
+        tss.insert(i := bisect_right(tss, d.ts), d.ts)
+        ks.insert(i, len(self.danmaku))
+        self.danmaku.append(d)
+        self.srcs.append(srcs)
+
+    def order(self) -> list[int]:
+        # the indices of the danmaku in ts order, i.e. the order of the output
+        return sorted(range(len(self.danmaku)), key=lambda k: self.danmaku[k].ts)
+
+
+class RecordCache():
+    # parsed DanmakuRecord pickled by content hash, with a sqlite index from (path, size, mtime) to the hash
+    # only the columns are pickled rather than the objects, so the blobs do not depend on how the script is imported
+    # the connection is opened lazily in each process, like IdTable
+
+    VERSION = 2                                                     # bump if DanmakuRecord/DanmakuList changes
+
+    def __init__(self, path:Path) -> None:
+        self.path = path
+        self.pid = None
+
+    @property
+    def db(self) -> sqlite3.Connection:
+        if self.pid != os.getpid():
+            self.pid = os.getpid()
+            self.path.mkdir(parents=True, exist_ok=True)
+            self._db = sqlite3.connect(self.path.joinpath('index.db'), timeout=60)
+            self._db.execute('PRAGMA journal_mode=WAL')
+            with self._db:
+                self._db.execute('CREATE TABLE IF NOT EXISTS files '
+                                 '(path TEXT PRIMARY KEY, size INTEGER, mtime INTEGER, hash TEXT) WITHOUT ROWID')
+        return self._db
+
+    def key(self, path:Path) -> str:
+        # the hash of the filename (which may hold the start time) and the content of the file
+        # only re-computed if its size or mtime changed
+        stat = path.stat()
+        if (row := self.db.execute('SELECT hash FROM files WHERE path = ? AND size = ? AND mtime = ?',
+                                   (str(path.resolve()), stat.st_size, stat.st_mtime_ns)).fetchone()):
+            return row[0]
+        (hasher := blake2b(digest_size=20)).update(bytes(path.name, 'utf-8'))
+        with path.open('rb') as fi:
+            while (chunk := fi.read(1 << 20)):
+                hasher.update(chunk)
+        with self.db:
+            self.db.execute('INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?)',
+                            (str(path.resolve()), stat.st_size, stat.st_mtime_ns, key := hasher.hexdigest()))
+        return key
+
+    def load(self, path:Path) -> DanmakuRecord:
+        # return the cached record of the file, or None
+        try:
+            blob = self.path.joinpath(f'{self.key(path)}.pickle')
+            version, rid, name, st, columns = pickle.loads(blob.read_bytes())
+            os.utime(blob)                                          # mtime of a blob is its last use for LRU
+        except Exception:                                           # missing or broken blob, just parse again
+            return None
+        if version != self.VERSION:
+            return None
+        record = DanmakuRecord.__new__(DanmakuRecord)
+        record.path = path                                          # the same content may come from another path
+        record.rid, record.name, record.st = rid, name, st
+        record.danmaku_lst = []
+        for cols in columns:
+            record.danmaku_lst.append(lst := DanmakuList.__new__(DanmakuList))
+            for k, v in cols.items():
+                setattr(lst, k, v)
+        return record
+
+    def save(self, path:Path, record:DanmakuRecord) -> None:
+        columns = [{k: getattr(lst, k) for k in DanmakuList.__slots__ if hasattr(lst, k)} for lst in record.danmaku_lst]
+        data = pickle.dumps((self.VERSION, record.rid, record.name, record.st, columns), protocol=5)
+        blob = self.path.joinpath(f'{self.key(path)}.pickle')
+        (tmp := blob.with_suffix(f'.{os.getpid()}.tmp')).write_bytes(data)
+        os.replace(tmp, blob)                                       # atomic, so concurrent runs never see half a blob
+        self.evict()
+
+    def evict(self) -> None:
+        # remove the least recently used records until the cache fits in RECORD_CACHE_SIZE
+        blobs = []
+        for blob in self.path.glob('*.pickle'):
+            try:
+                blobs.append(((stat := blob.stat()).st_mtime_ns, stat.st_size, blob))
+            except OSError:                                         # removed by another process
+                pass
+        total = sum(map(itemgetter(1), blobs))
+        for _, size, blob in sorted(blobs):
+            if total <= RECORD_CACHE_SIZE:
+                break
+            blob.unlink(missing_ok=True)
+            total -= size
+
+    def clear(self) -> None:
+        for blob in self.path.glob('*.pickle'):
+            blob.unlink(missing_ok=True)
+        with self.db:
+            self.db.execute('DELETE FROM files')
+
+
+RECORD_CACHE = RecordCache(Path(__file__).parent.joinpath(RECORD_CACHE_PATH))
+
+
+class MergeStats():
+    # the time of each stage and the counters of a merge, reported by '--stats'
+    # the cpu time includes the finished child processes, i.e. the workers of '--jobs'
+
+    def __init__(self) -> None:
+        self.stages = {}                                            # name -> [wall, cpu]
+        self.records = []
+        self.pairs = []                                             # the counters of DanmakuIndex per record pair
+        self.drifts = []
+        self.tdiffs = []
+        self.danmaku = {}
+
+    @contextmanager
+    def stage(self, name:str) -> Iterator[None]:
+        t0, c0 = perf_counter(), sum(os.times()[:4])
+        try:
+            yield
+        finally:
+            wall, cpu = self.stages.setdefault(name, [0.0, 0.0])
+            self.stages[name] = [wall + perf_counter() - t0, cpu + sum(os.times()[:4]) - c0]
+
+    def add(self, stages:dict) -> None:
+        # add the stage times measured elsewhere, i.e. in a worker process
+        for name, (wall, cpu) in stages.items():
+            total = self.stages.setdefault(name, [0.0, 0.0])
+            self.stages[name] = [total[0] + wall, total[1] + cpu]
+
+    def report(self) -> dict:
+        return {'records': self.records,
+                'danmaku': self.danmaku,
+                'stages': {name: {'wall': wall, 'cpu': cpu} for name, (wall, cpu) in self.stages.items()},
+                'pairs': self.pairs,
+                'drifts': self.drifts,
+                'tdiffs': self.tdiffs,
+                'id_table': ID_TABLE.counts,
+                'peak_rss': peakRss()}
+
+
+STATS = MergeStats()
+
+
+class DanmakuIndex():
+    # the unmerged danmaku of a record grouped by (type, text) and sorted by ts
+    # so that a lookup only visits the candidates within the TIME_TOLERANCE window instead of rescanning the record
+
+    def __init__(self, record:DanmakuRecord) -> None:
+        self.table = {}
+        self.compared = 0                                           # the candidates visited, for '--stats'
+        self.matched = 0
+        for lst in record.danmaku_lst:
+            groups = {}
+            for i, text in enumerate(lst.text):
+                groups.setdefault(text, []).append(i)
+            for text, idxs in groups.items():
+                idxs.sort(key=lst.ts.__getitem__)                   # stable, so ties keep the order in the file
+                self.table[(lst.type, text)] = (lst, [lst.ts[i] for i in idxs], idxs)
+
+    def pop_match(self, rl:DanmakuList, ri:int, offset:float, tolerance:float=TIME_TOLERANCE) -> int:
+        # find, mark as merged and return the index of the earliest danmaku equal to `rl[ri]` when shifted by `offset`
+        # return None if there is no such danmaku within `tolerance`
+        if not (entry := self.table.get((rl.type, rl.text[ri]))):
+            return None
+        lst, tss, idxs = entry
+        i = i0 = bisect_right(tss, (rts := rl.ts[ri]) - offset - tolerance)
+        while i < len(tss) and (ts := tss[i] + offset) - rts < tolerance:
+            if abs(rts - ts) < tolerance and rl.match(ri, lst, j := idxs[i]):
+                tss.pop(i)
+                idxs.pop(i)
+                lst.merged[j] = 1
+                self.compared += i - i0 + 1
+                self.matched += 1
+                return j
+            i += 1
+        self.compared += i - i0
+        return None
+
+
 '''=====================================================================================================================
-MAIN
+HELPER FUNCTIONS
 ====================================================================================================================='''
 
-def main(args):
+@lru_cache(maxsize=None)
+def uidcrc(uid:str) -> str:
+    # the crc32 of a uid as used by https://matsuri.icu, cached since each user usually sends many danmaku
+    return f'{crc32(bytes(uid, "utf-8")):x}'
+
+
+def peakRss() -> int:
+    # the peak resident memory of this process in bytes, or 0 if unknown
+    if resource:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * (1 if sys.platform == 'darwin' else 1024)
+    if psutil:
+        return getattr(psutil.Process().memory_info(), 'peak_wset', 0)
+    return 0
+
+
+def iterXmlTags(path:Path) -> Iterator[tuple[str, str, dict]]:
+    # yield (name, text, attrs) of each child of the root in a single pass without keeping the tree in memory
+    depth = 0
+    for event, elem in iterparse(path, events=('start', 'end')):
+        if event == 'start':
+            if not depth: root = elem
+            depth += 1
+            continue
+        if (depth := depth - 1) == 1:
+            yield elem.tag, ''.join(elem.itertext()), dict(elem.attrib)
+            root.clear()                                            # drop the finished children
+
+
+def iterSoupTags(path:Path) -> Iterator[tuple[str, str, dict]]:
+    # the same as iterXmlTags() but loads the whole file with BS, which tolerates malformed xml
+    soup = BS(path.read_bytes(), 'xml')
+    for tag in soup.find_all(['BililiveRecorderRecordInfo', *DANMAKU_TYPES]):
+        yield tag.name, tag.text, dict(tag.attrs)
+
+
+def estimateDrifts(records:list[DanmakuRecord], offsets:list[float]) -> list[float]:
+    # estimate the seconds to add to the offset of each record to align its clock with the first record
+    # each record is binned into a histogram over (text hash, time), and every pair is cross-correlated via FFT
+    # the drift of a record comes from the earlier record it correlates best with, or is None if no peak stands out
+    drifts = [0.0] + [None] * (len(records) - 1)
+    if not np or len(records) < 2:
+        return drifts
+    hashes = {}
+    events = []
+    for record, offset in zip(records, offsets):
+        ts = np.concatenate([np.frombuffer(lst.ts, dtype=np.float64) + offset for lst in record.danmaku_lst])
+        hs = np.fromiter((hashes[key] if (key := (lst.type, text)) in hashes else
+                          hashes.setdefault(key, crc32(bytes(lst.type + text, 'utf-8')))
+                          for lst in record.danmaku_lst for text in lst.text), dtype=np.int64, count=len(ts))
+        events.append((ts, hs))
+    if not (tss := [ts for ts, _ in events if len(ts)]):
+        return drifts
+    buckets = min(DRIFT_HASH_BUCKETS, 1 << (len(hashes) // DRIFT_TEXTS_PER_BUCKET).bit_length())
+    lo = min(map(np.min, tss))
+    nbins = int((max(map(np.max, tss)) - lo) / DRIFT_BIN) + 1
+    lag = int(TIME_TOLERANCE / DRIFT_BIN)
+    nfft = 1 << (nbins + lag).bit_length()
+    cells = [(hs % buckets) * nbins + ((ts - lo) / DRIFT_BIN).astype(np.int64) for ts, hs in events]
+    cross = {}
+    for b in range(0, buckets, step := min(buckets, 32)):           # a slice of buckets at a time to bound the memory
+        spectra = []
+        for c in cells:
+            hist = np.bincount(c[(c >= b * nbins) & (c < (b + step) * nbins)] - b * nbins, minlength=step * nbins)
+            spectra.append(np.fft.rfft(hist.reshape(step, nbins).astype(np.float32), nfft, axis=1))
+        for j in range(1, len(records)):
+            for i in range(j):
+                cross[i, j] = cross.get((i, j), 0) + (spectra[i] * spectra[j].conj()).sum(axis=0)
+    for j in range(1, len(records)):
+        peak = 0.0
+        for i in range(j):
+            if drifts[i] is None:
+                continue
+            corr = np.fft.irfft(cross[i, j], nfft)
+            corr = np.concatenate([corr[-lag:], corr[:lag+1]])      # corr[k] counts the pairs `k - lag` bins apart
+            corr -= np.median(corr)                                 # the pairs of unrelated danmaku of similar texts
+            mad = float(np.median(np.abs(corr)))
+            if (c := corr[k := int(corr.argmax())]) >= max(DRIFT_MIN_PEAK, DRIFT_MIN_SCORE * mad, peak):
+                ks = np.arange(max(0, k-1), min(len(corr), k+2))    # refine the peak by its neighbours
+                w = np.maximum(corr[ks], 0)
+                drifts[j] = drifts[i] + float((w * ks).sum() / w.sum() - lag) * DRIFT_BIN
+                peak = c
+    return drifts
+
+
+def loadRecord(path:Path, cache:bool=True) -> DanmakuRecord:
+    # load the recording from RECORD_CACHE or parse it, then look up ID_TABLE
+    with STATS.stage('cache') if cache else nullcontext():
+        record = RECORD_CACHE.load(path) if cache else None
+    if not record:
+        with STATS.stage('parse'):
+            record = DanmakuRecord(path)
+        if cache:
+            with STATS.stage('cache'):
+                RECORD_CACHE.save(path, record)
+    with STATS.stage('lookup'):
+        record.lookup()
+    return record
+
+
+def loadRecordInWorker(path:Path, cache:bool=True) -> tuple[DanmakuRecord, dict, dict]:
+    # loadRecord() in a worker process, also returning the stage times and ID_TABLE counters it added to the worker
+    # so that the parent can add them to its own for '--stats'
+    stages = {name: [*times] for name, times in STATS.stages.items()}
+    counts = dict(ID_TABLE.counts)
+    record = loadRecord(path, cache)
+    return (record,
+            {name: [wall - stages.get(name, [0.0, 0.0])[0], cpu - stages.get(name, [0.0, 0.0])[1]]
+             for name, (wall, cpu) in STATS.stages.items()},
+            {k: v - counts[k] for k, v in ID_TABLE.counts.items()})
+
+
+def loadRecords(paths:list[Path], jobs:int=1, cache:bool=True) -> list[DanmakuRecord]:
+    # load the recordings in parallel if requested, keeping the input order
+    # ID_TABLE is only read during loading and only updated during merging, so every worker sees the same table
+    if jobs > 1 and len(paths) > 1:
+        records = []
+        with ProcessPoolExecutor(min(jobs, len(paths))) as executor:
+            for record, stages, counts in executor.map(partial(loadRecordInWorker, cache=cache), paths):
+                STATS.add(stages)
+                for k, v in counts.items():
+                    ID_TABLE.counts[k] += v
+                records.append(record)
+        return records
+    return [loadRecord(path, cache) for path in paths]
+
+
+def probeRecord(path:Path) -> tuple[str, datetime, datetime]:
+    # find the room id and the time range of a recording without parsing it
+    # the start comes from the record info or the filename, and the end from the last timestamp in the file
+    with path.open('rb') as fi:
+        head = fi.read(PROBE_SIZE).decode('utf-8', 'ignore')
+        fi.seek(max(0, path.stat().st_size - PROBE_SIZE))
+        tail = fi.read().decode('utf-8', 'ignore')
+    if (m := re.search(r'<BililiveRecorderRecordInfo\s[^>]*', head)):
+        rid = (attrs := dict(re.findall(r'(\w+)="([^"]*)"', m[0]))).get('roomid', '')
+        st = isoparse(attrs['start_time'])
+    elif (m := re.match(BILIREC_FILENAME_PATTERN, path.stem)):
+        rid = m['room_id']
+        st = isoparse(f"{m['date']}-{m['time']}").replace(tzinfo=TIME_ZONE)
+    elif (m := re.match(MATSURI_FILENAME_PATTERN, path.stem)):
+        rid = ''
+        st = datetime.fromtimestamp(int(m['millisec'])/1000, TIME_ZONE)
+    else:
+        raise ValueError(f'Cannot parse the start time from \'{path}\'')
+    tss = [*map(float, re.findall(r'\s(?:p|ts)="([0-9.]+)[,"]', tail))]
+    return rid, st, st + td(seconds=max(tss, default=0.0))
+
+
+def groupRecords(paths:list[Path]) -> tuple[list[list[Path]], list[Path]]:
+    # group the recordings of the same live session: BiliRec ones by room id and overlapping time
+    # then add each matsuri.icu one (which has no room id) to the only overlapping group, preferring the same dir
+    # return the groups and the files that cannot be grouped
+    probes, ungrouped = [], []
+    for path in paths:
+        try:
+            probes.append((*probeRecord(path), path))
+        except (ValueError, OSError):
+            ungrouped.append(path)
+    groups = []
+    for rid, st, et, path in sorted(filter(itemgetter(0), probes), key=itemgetter(0, 1)):
+        if groups and groups[-1]['rid'] == rid and (st - groups[-1]['et']).total_seconds() < TIME_TOLERANCE:
+            groups[-1]['et'] = max(et, groups[-1]['et'])
+            groups[-1]['paths'].append(path)
+        else:
+            groups.append({'rid': rid, 'st': st, 'et': et, 'paths': [path]})
+    for _, st, et, path in filter(lambda x: not x[0], probes):
+        overlaps = [g for g in groups if (st - g['et']).total_seconds() < TIME_TOLERANCE
+                                     and (g['st'] - et).total_seconds() < TIME_TOLERANCE]
+        if len(overlaps) > 1:
+            overlaps = [g for g in overlaps if path.parent in map(attrgetter('parent'), g['paths'])]
+        if len(overlaps) == 1:
+            overlaps[0].setdefault('matsuri', []).append(path)
+        else:
+            ungrouped.append(path)
+    ret = []
+    for g in groups:
+        if len(group := g['paths'] + g.get('matsuri', [])) > 1:     # BiliRec first so the reference has full info
+            ret.append(group)
+        else:
+            ungrouped.extend(group)
+    return ret, ungrouped
+
+
+def writeDanmakuXml(path:Path, danmaku:Iterable[Danmaku], rid:str, name:str, st:datetime) -> None:
+    # stream the output to the file instead of building it as a tree
+    with path.open('w', encoding='utf_8_sig', newline='') as fo:
+        fo.write('<?xml version="1.0" encoding="utf-8"?>\n')
+        fo.write(XML_TEMPLATE[:-len('</i>')])
+        fo.write(f'<BililiveRecorderRecordInfo room_id={quoteattr(rid)} name={quoteattr(name)} '
+                 f'start_time={quoteattr(st.isoformat())}></BililiveRecorderRecordInfo>')
+        fo.writelines(map(attrgetter('xml'), danmaku))
+        fo.write('</i>')
+
 
-    danmaku_records = [*map(DanmakuRecord, args.input)]
+'''=====================================================================================================================
+MAIN
+====================================================================================================================='''
+
+def recordInfo(danmaku_records:list[DanmakuRecord]) -> tuple[str, str, datetime]:
+    # the room id, the streamer name and the start time for the merged output
     assert len(rids := [*filter(None, [r.rid for r in danmaku_records])]) == 0 or rids.count(rids[0]) == len(rids)
     rid = rids[0] if rids else ''
     assert len(names := [*filter(None, [r.name for r in danmaku_records])]) == 0 or names.count(names[0]) == len(names)
     name = names[0] if names else ''
+    return rid, name, danmaku_records[0].st
 
-    st = (sts := [*map(attrgetter('st'), danmaku_records)])[0]
-    offsets = [(t - st).total_seconds() for t in sts]
-    output = BS(XML_TEMPLATE, features='xml')
-    output.i.append(TAG(name='BililiveRecorderRecordInfo', attrs={'room_id':rid, 'name':name, 'start_time':st.isoformat()}))
 
+def matchRecords(danmaku_records:list[DanmakuRecord], offsets:list[float], drifts:list[float],
+                 progress:bool=True) -> list[Danmaku]:
+    # shift every danmaku by the offset of its recording and return those not merged into an earlier recording
     out = []
+    indices = [*map(DanmakuIndex, danmaku_records)]
     tdiffs = {'diff': 0.0, 'num': 0, 'sum': 0.0} # used to record the average time diffs between two recordings
-    with tqdm(total=sum(map(len, danmaku_records))) as pbar:
+    # which corrects the next record if its drift could not be estimated, otherwise it is only reported in STATS
+    with tqdm(total=sum(map(len, danmaku_records)), disable=not progress) as pbar:
         for rdri, rdr in enumerate(danmaku_records):                                            # Ref_Rec_Idx and Ref_Rec
             tdiffs = {'diff': tdiffs['sum'] / max(1, tdiffs['num']), 'num': 0, 'sum': 0.0}
+            STATS.tdiffs.append(tdiffs['diff'])
+            counts = [(index.compared, index.matched) for index in indices]
             for di in range(4):
-                for rdi, rd in enumerate(rdr.danmaku_lst[di]):                                  # Ref_Danmaku_Idx and Ref_Danmaku
-                    rd.ts += offsets[rdri] + tdiffs['diff']
+                rl = rdr.danmaku_lst[di]                                                        # Ref_List
+                for ri in range(len(rl)):                                                       # Ref_Danmaku_Idx
+                    if rl.merged[ri]:                                                           # already merged into an earlier record
+                        continue
+                    rl.ts[ri] += offsets[rdri] - (tdiffs['diff'] if drifts[rdri] is None else 0.0)
                     pbar.update(1)
-                    for odri, odr in enumerate(danmaku_records[rdri+1:], start=rdri+1):         # Other_DanmakuRecord_Idx and Other_DanmakuRecord
-                        for odi, od in enumerate(odr.danmaku_lst[di]):                          # Other_Danmaku_Idx and Other_Danmaku
-                            od.ts += offsets[odri]
-                            if od.ts - rd.ts > TIME_TOLERANCE:
-                                od.ts -= offsets[odri]
-                                break
-                            if rd == od:
-                                danmaku_records[odri].danmaku_lst[di].pop(odi)
-                                pbar.update(1)
-                                if odri - rdri == 1:
-                                    tdiffs['num'] += 1
-                                    tdiffs['sum'] += od.ts - rd.ts
-                                break
-                            od.ts -= offsets[odri]
-                    out.append(rd) # place here since in comparison rm will be updated
-
-    output.i.extend([*map(attrgetter('tag'), sorted(out, key=lambda x: x.ts))])
-    out_path = args.output if args.output else args.input[0].with_suffix('.merged.xml')
-    out_path.write_bytes(bytes(str(output), 'utf_8_sig'))
-    if WRITE_ID_TABLE: Path(ID_TABLE_PATH).write_bytes(bytes(json.dumps(ID_TABLE), 'utf-8'))
+                    for odri in range(rdri+1, len(danmaku_records)):                            # Other_DanmakuRecord_Idx
+                        tolerance = TIME_TOLERANCE if None in (drifts[rdri], drifts[odri]) else MATCH_TOLERANCE
+                        if (odi := indices[odri].pop_match(rl, ri, offsets[odri], tolerance)) is not None:
+                            pbar.update(1)
+                            if odri - rdri == 1:
+                                tdiffs['num'] += 1
+                                tdiffs['sum'] += danmaku_records[odri].danmaku_lst[di].ts[odi] + offsets[odri] - rl.ts[ri]
+                    out.append(rl[ri]) # place here since in comparison rm will be updated
+            STATS.pairs.extend({'ref': rdri, 'other': odri,
+                                'compared': indices[odri].compared - counts[odri][0],
+                                'matched': indices[odri].matched - counts[odri][1]}
+                               for odri in range(rdri+1, len(danmaku_records)))
+    return out
+
+
+def merge(paths:list[Path], out_path:Path, jobs:int=1, progress:bool=True, cache:bool=True,
+          profile:Path=None) -> tuple[int, int]:
+    # merge the recordings into `out_path`, return the number of input and output danmaku
+    # if `profile` is given, the matching is profiled and its stats are dumped there
+
+    with STATS.stage('load'):
+        danmaku_records = loadRecords(paths, jobs, cache)
+    rid, name, st = recordInfo(danmaku_records)
+    sts = [*map(attrgetter('st'), danmaku_records)]
+    offsets = [(t - st).total_seconds() for t in sts]
+    with STATS.stage('drift'):
+        drifts = estimateDrifts(danmaku_records, offsets)
+    offsets = [offset + (drift or 0.0) for offset, drift in zip(offsets, drifts)]
+
+    with STATS.stage('match'):
+        if profile:
+            out = (profiler := cProfile.Profile()).runcall(matchRecords, danmaku_records, offsets, drifts, progress)
+            profiler.dump_stats(profile)
+        else:
+            out = matchRecords(danmaku_records, offsets, drifts, progress)
+    with STATS.stage('serialize'):
+        writeDanmakuXml(out_path, sorted(out, key=attrgetter('ts')), rid, name, st)
+
+    STATS.records += map(str, paths)
+    STATS.drifts += drifts
+    STATS.danmaku = {'in': sum(map(len, danmaku_records)), 'out': len(out)}
+    return STATS.danmaku['in'], STATS.danmaku['out']
+
+
+def streamMerge(streams:list[DanmakuStream], offsets:list[float], counts:dict) -> Iterator[Danmaku]:
+    # k-way merge the streams by ts and yield the deduplicated danmaku in order
+    # a danmaku claims its matches from later streams once all of them have arrived, i.e. TIME_TOLERANCE later
+    # and is yielded once no danmaku from an earlier stream can claim it any more, i.e. 2 * TIME_TOLERANCE later
+
+    def shifted(r:int) -> Iterator[tuple[float, int, Danmaku]]:
+        ts = float('-inf')
+        for d in streams[r]:
+            d.ts += offsets[r]
+            yield (ts := d.ts), r, d
+        ends[r] = ts
+
+    ends = [None] * len(streams)                                    # the last ts of each finished stream
+
+    windows = [None] + [{} for _ in streams[1:]]                    # (type, text) -> deque of danmaku, per stream
+                                                                    # except the first, which is never claimed from
+    arrived = deque()                                               # danmaku waiting for all their matches
+    decided = deque()                                               # danmaku waiting to be yielded
+    front = heapmerge(*map(shifted, range(len(streams))), key=itemgetter(0))
+    for t, r, d in chain(front, [(float('inf'), -1, None)]):
+        own = None
+        if d:
+            if r and (None in ends[:r] or d.ts - max(ends[:r]) < TIME_TOLERANCE):   # an earlier stream may claim it
+                (own := windows[r].setdefault((d.type, d.text), deque())).append(d)
+            arrived.append((r, d))
+            counts['in'] += 1
+        while arrived and arrived[0][1].ts <= t - TIME_TOLERANCE:
+            er, e = arrived.popleft()
+            decided.append(e)
+            if e.lst.merged[e.i]:
+                continue
+            for window in windows[er+1:]:
+                if not (dq := window.get((e.type, e.text))):
+                    continue
+                while dq and dq[0].ts <= e.ts - TIME_TOLERANCE:    # too early for this and any later danmaku
+                    dq.popleft()
+                for k, c in enumerate(dq):
+                    if c.ts - e.ts >= TIME_TOLERANCE:
+                        break
+                    if not c.lst.merged[c.i] and e.lst.match(e.i, c.lst, c.i):
+                        c.lst.merged[c.i] = 1
+                        del dq[k]
+                        break
+        if own:                                                     # every danmaku left in `arrived` is later than
+            while own and own[0].ts <= t - 2 * TIME_TOLERANCE:      # t - TIME_TOLERANCE, so these can't be claimed
+                own.popleft()
+        while decided and decided[0].ts <= t - 2 * TIME_TOLERANCE:
+            if not (e := decided.popleft()).lst.merged[e.i]:
+                counts['out'] += 1
+                yield e
+        if counts['in'] % 16384 == 0:                               # also expire the texts not seen for a while
+            for window in windows[1:]:
+                for key, dq in [*window.items()]:
+                    while dq and dq[0].ts <= t - 2 * TIME_TOLERANCE:
+                        dq.popleft()
+                    if not dq:
+                        del window[key]
+
+
+def mergeStream(paths:list[Path], out_path:Path, progress:bool=True) -> tuple[int, int]:
+    # the same as merge() but with memory bounded by the danmaku within a few TIME_TOLERANCE rather than the inputs
+    # the inputs are not cached and their clock drift is not estimated, so TIME_TOLERANCE is used for matching
+
+    streams = [*map(DanmakuStream, paths)]
+    rid, name, st = recordInfo(streams)
+    offsets = [(s.st - st).total_seconds() for s in streams]
+    counts = {'in': 0, 'out': 0}
+    danmaku = tqdm(streamMerge(streams, offsets, counts), disable=not progress, unit=' danmaku')
+    writeDanmakuXml(out_path, danmaku, rid, name, st)
+    return counts['in'], counts['out']
+
+
+def follow(paths:list[Path], out_path:Path, interval:float=FOLLOW_INTERVAL) -> None:
+    # merge the recordings while they are being written, rewriting `out_path` every `interval` seconds
+    # the read positions are saved along with each output, so a restart loads the output and resumes from there
+
+    checkpoint = json.loads(cp_path.read_bytes()) if (cp_path := out_path.with_suffix('.follow.json')).is_file() else {}
+    if checkpoint.get('size') != (out_path.stat().st_size if out_path.is_file() else None):
+        checkpoint = {}                                             # interrupted between writing the two, start over
+    sources = [FollowedRecord(path, checkpoint.get('sources', {}).get(str(path))) for path in paths]
+    new = [s.poll() for s in sources]
+    while not all(s.st for s in sources):                           # wait for all recordings to have a start time
+        sleep(interval)
+        new = [n + s.poll() for n, s in zip(new, sources)]
+    rid, name, st = recordInfo(sources)
+    offsets = [(s.st - st).total_seconds() for s in sources]
+
+    pool = DanmakuPool()
+    records = [*sources]                                            # to lookup() the danmaku from
+    if checkpoint:                                                  # the danmaku merged before the restart
+        for lst in (prev := loadRecord(out_path, cache=False)).danmaku_lst:
+            for i, srcs in enumerate(checkpoint['srcs'][lst.type]):  # in the same order as in the output
+                pool.keep(lst[i], srcs)
+        records.append(prev)
+    try:
+        with tqdm(unit=' danmaku') as pbar:
+            while True:
+                for r, danmaku in enumerate(new):
+                    for d in danmaku:
+                        d.ts += offsets[r]
+                        pool.add(r, d)
+                    pbar.update(len(danmaku))
+                for r in records:                                   # ID_TABLE may have learnt more users since
+                    r.lookup()
+                order = pool.order()                                # nearly sorted, so this is cheap
+                writeDanmakuXml(tmp := out_path.with_suffix('.tmp'), map(pool.danmaku.__getitem__, order), rid, name, st)
+                os.replace(tmp, out_path)                           # the output is always a complete xml
+                srcs = {t: [] for t in DANMAKU_TYPES}
+                for k in order:
+                    srcs[pool.danmaku[k].type].append(pool.srcs[k])
+                tmp.write_bytes(bytes(json.dumps({'size': out_path.stat().st_size, 'srcs': srcs,
+                                                  'sources': {str(s.path): s.checkpoint for s in sources}}), 'utf-8'))
+                os.replace(tmp, cp_path)
+                ID_TABLE.flush()
+                if all(s.finished for s in sources):
+                    break
+                sleep(interval)
+                new = [s.poll() for s in sources]
+    except KeyboardInterrupt:
+        pass                                                        # the last flush is complete, just resume later
+
+
+def mergeGroup(paths:list[Path], cache:bool=True) -> tuple[int, int, str]:
+    # merge a group in batch mode, return the numbers of danmaku and the error if any
+    try:
+        return (*merge(paths, paths[0].with_suffix('.merged.xml'), progress=False, cache=cache), '')
+    except Exception as e:
+        return 0, 0, f'{type(e).__name__}: {e}'
+    finally:
+        ID_TABLE.flush()                                            # the db takes care of concurrent workers
+
+
+def batch(paths:list[Path], jobs:int=1, force:bool=False, cache:bool=True) -> None:
+
+    files = []
+    for path in paths:
+        files += sorted(path.resolve().rglob('*.xml')) if path.is_dir() else [path.resolve()]
+    groups, ungrouped = groupRecords([f for f in files if not f.name.endswith('.merged.xml')])
+
+    state = json.loads(sp.read_bytes()) if (sp := Path(__file__).parent.joinpath(BATCH_STATE_PATH)).is_file() else {}
+    todo, skipped = [], []
+    for group in groups:
+        stamp = [[str(p), (stat := p.stat()).st_size, stat.st_mtime_ns] for p in group]
+        out_path = group[0].with_suffix('.merged.xml')
+        if not force and out_path.is_file() and state.get(str(out_path)) == stamp:
+            skipped.append(group)
+        else:
+            todo.append((group, stamp))
+
+    report = []
+    with (ProcessPoolExecutor(jobs) if jobs > 1 else nullcontext()) as executor:
+        results = (executor.map if executor else map)(partial(mergeGroup, cache=cache), [group for group, _ in todo])
+        for (group, stamp), (n_in, n_out, error) in tqdm(zip(todo, results), total=len(todo)):
+            if not error:
+                state[str(group[0].with_suffix('.merged.xml'))] = stamp
+            report.append((group, n_in, n_out, error))
+    sp.write_bytes(bytes(json.dumps(state, ensure_ascii=False, indent=1), 'utf-8'))
+
+    for group, n_in, n_out, error in report:
+        print(f'{"FAILED" if error else "merged"} {len(group)} files, {n_in} -> {n_out} danmaku: {group[0]}')
+        if error: print(f'    {error}')
+    for group in skipped:
+        print(f'skipped {len(group)} files (unchanged): {group[0]}')
+    for path in ungrouped:
+        print(f'ungrouped: {path}')
+    print(f'{len(groups)} groups: {sum(not r[3] for r in report)} merged, {sum(bool(r[3]) for r in report)} failed, '
+          f'{len(skipped)} skipped; {len(ungrouped)} files ungrouped')
+
+
+def main(args):
+
+    if args.clear_cache:
+        RECORD_CACHE.clear()
+    if args.batch:
+        batch(args.input, args.jobs, args.force, args.cache)
+    elif args.follow:
+        follow(args.input, args.output if args.output else args.input[0].with_suffix('.merged.xml'), args.follow)
+    elif args.stream:
+        mergeStream(args.input, args.output if args.output else args.input[0].with_suffix('.merged.xml'))
+    else:
+        out_path = args.output if args.output else args.input[0].with_suffix('.merged.xml')
+        merge(args.input, out_path, args.jobs, cache=args.cache, profile=args.profile)
+    with STATS.stage('id_table'):
+        ID_TABLE.flush()
+    if args.stats:
+        args.stats.write_text(json.dumps(STATS.report(), indent=2, ensure_ascii=False), encoding='utf-8')
 
 '''=====================================================================================================================
 CLI Interface
@@ -233,12 +1223,37 @@ class _CustomHelpFormatter(argparse.HelpFormatter):
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(prog='tu', formatter_class=lambda prog: _CustomHelpFormatter(prog))
     parser.add_argument('input', type=Path, action='extend', nargs='+',
-                        help='xml subtitle fils to merge', metavar='path')
-    parser.add_argument('-o', '--output', dest='output', type=Path, nargs=1,
+                        help='xml subtitle fils to merge, or dirs to scan in batch mode', metavar='path')
+    parser.add_argument('-o', '--output', dest='output', type=Path,
                         help='the desired output location', metavar='path')
+    parser.add_argument('-j', '--jobs', dest='jobs', type=int, default=1,
+                        help='the number of processes to parse the input files, or to merge groups in batch mode '
+                             '(default=1)', metavar='n')
+    parser.add_argument('-b', '--batch', dest='batch', action='store_true', default=False,
+                        help='scan the given dirs, group the recordings by live session and merge each group')
+    parser.add_argument('-s', '--stream', dest='stream', action='store_true', default=False,
+                        help='merge in a single pass with bounded memory, for very long or many-segment sessions')
+    parser.add_argument('--follow', dest='follow', type=float, nargs='?', const=FOLLOW_INTERVAL, default=None,
+                        help='keep merging the recordings while they are being written, flushing the output every '
+                             f'`sec` seconds (default={FOLLOW_INTERVAL})', metavar='sec')
+    parser.add_argument('-f', '--force', dest='force', action='store_true', default=False,
+                        help='re-merge the groups that are unchanged since the last batch run')
+    parser.add_argument('--no-cache', dest='cache', action='store_false', default=True,
+                        help='always parse the input files, neither reading nor updating the record cache')
+    parser.add_argument('--clear-cache', dest='clear_cache', action='store_true', default=False,
+                        help='empty the record cache before running')
+    parser.add_argument('--stats', dest='stats', type=Path,
+                        help='write the time of each stage, the matching counters and the peak memory of the merge '
+                             'as json to this file', metavar='path')
+    parser.add_argument('--profile', dest='profile', type=Path,
+                        help='profile the matching of the merge and dump the stats to this file for pstats',
+                        metavar='path')
     # sys.argv.append(r"Z:\录制-1321846-20210216-130051-【B】NieR_Automata.xml")
     # sys.argv.append(r"Z:\夏诺雅_shanoa_【B】NieR_Automata_1613480435698.xml")
     # # sys.argv.append(r"E:\v\1321846-夏诺雅_shanoa\夏诺雅_shanoa_【B】小小梦魇_1613307688203.xml")
     # # sys.argv.append(r"E:\v\1321846-夏诺雅_shanoa\录制-1321846-20210214-130304-【B】小小梦魇.xml")
     # # sys.argv.append(r"E:\v\1321846-夏诺雅_shanoa\录制-1321846-20210214-130308-【B】小小梦魇.xml")
-    main(parser.parse_args())
+    args = parser.parse_args()
+    if (args.stats or args.profile) and (args.batch or args.stream or args.follow):
+        parser.error('--stats and --profile only apply to the plain merge, not to -b, -s or --follow')
+    main(args)
@@ -0,0 +1,139 @@
+'''
+Run updU2SecKey.py against a local stand-in of the U2 JSON-RPC api, so it can be checked without an api key.
+The torrents are small json files in a temporary dir, read by a stand-in of tu.fromTorrent.
+The stand-in server fails the first request, answers the rest in reverse order, drops some ids and returns errors for
+some hashes, while recording when each request arrives. The run is then repeated to check that it resumes.
+'''
+
+import sys; assert sys.version_info >= (3, 8)
+import json
+import hashlib
+import argparse
+import tempfile
+import threading
+from pathlib import Path
+from time import monotonic
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import updU2SecKey as u2                # the script to test, alongside
+
+# config
+NUM_TORRENTS = 250                      # 3 batches
+FAIL_FIRST = 1                          # the number of the first requests answered with 503, to be retried
+MIN_GAP = 2.0                           # the minimum interval required by the api between any two requests
+
+
+class StandInTorrent():
+    # the part of tu.Torrent used by updU2SecKey.py, stored as json
+
+    def __init__(self, data: dict):
+        self.data = data
+        self.hash = data['hash']
+        self.announce = data['announce']
+
+    def write(self, path: Path, overwrite: bool = False):
+        assert overwrite or not path.exists()
+        path.write_text(json.dumps({**self.data, 'announce': self.announce}), encoding='utf-8')
+
+
+def loadStandIn(path: Path) -> StandInTorrent:
+    return StandInTorrent(json.loads(path.read_bytes()))
+
+
+def keyOf(h: str) -> str:
+    return hashlib.md5(h.encode()).hexdigest()
+
+
+def answerOf(r: dict) -> dict:
+    # the response to a query, or None for the hashes whose answers are dropped
+    if (h := r['params'][0]).endswith('0'):
+        return None
+    if h.endswith('f'):
+        return {'jsonrpc': '2.0', 'id': r['id'], 'error': {'code': 404, 'message': 'torrent not found'}}
+    return {'jsonrpc': '2.0', 'id': r['id'], 'result': keyOf(h)}
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+
+    def do_POST(self):
+        server = self.server
+        batch = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+        with server.lock:
+            server.arrivals.append(monotonic())
+            fail = len(server.arrivals) <= server.fail_first
+            if not fail:
+                server.queried += [r['params'][0] for r in batch]
+        if fail:
+            self.send_response(503)
+            self.end_headers()
+            return
+        res = [a for r in reversed(batch) if (a := answerOf(r))]
+        res.append({'jsonrpc': '2.0', 'id': None, 'error': {'code': -32600, 'message': 'invalid request'}})
+        data = json.dumps(res).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, *args):
+        pass
+
+
+def runOnce(server, args) -> tuple:
+    # run updU2SecKey.py once, return the gaps between the requests and the hashes queried
+    with server.lock:
+        server.arrivals, server.queried = [], []
+    u2.main(args, load=loadStandIn)
+    return [b - a for a, b in zip(server.arrivals, server.arrivals[1:])], server.queried
+
+
+def main(args):
+
+    errors = []
+    with tempfile.TemporaryDirectory() as tmp:
+        torrent_dir = Path(tmp, 'torrents')
+        torrent_dir.mkdir()
+        hashes = [hashlib.sha1(str(i).encode()).hexdigest() for i in range(args.num)]
+        for i, h in enumerate(hashes):
+            torrent_dir.joinpath(f'{i:05d}.torrent').write_text(
+                json.dumps({'hash': h, 'announce': u2.ANNOUNCE.format('old')}), encoding='utf-8')
+        u2.KEY_CACHE = Path(tmp, 'keys.json')
+
+        server = ThreadingHTTPServer(('127.0.0.1', 0), StandInHandler)
+        server.lock, server.fail_first = threading.Lock(), FAIL_FIRST
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        run = argparse.Namespace(dir=torrent_dir, url=f'http://127.0.0.1:{server.server_address[1]}/jsonrpc',
+                                 jobs=args.jobs, reset=False)
+
+        print('first run, some errors are expected:')
+        gaps, queried = runOnce(server, run)
+        if (short := [g for g in gaps if g < MIN_GAP]):
+            errors.append(f'{len(short)} requests came less than {MIN_GAP} sec apart: {min(short):.3f} sec')
+        if sorted(queried) != sorted(hashes):
+            errors.append(f'{len(queried)} hashes were queried instead of {len(hashes)}')
+        failed = {h for h in hashes if not (a := answerOf({'id': 0, 'params': [h]})) or 'error' in a}
+        cache = json.loads(u2.KEY_CACHE.read_bytes())
+        for i, h in enumerate(hashes):
+            announce = loadStandIn(torrent_dir.joinpath(f'{i:05d}.torrent')).announce
+            expected = u2.ANNOUNCE.format('old' if h in failed else keyOf(h))
+            if announce != expected or cache.get(h) != (None if h in failed else keyOf(h)):
+                errors.append(f'{i:05d}.torrent has {announce} and {cache.get(h)} cached')
+
+        print('second run, only the failed ones should be queried:')
+        gaps, queried = runOnce(server, run)
+        if sorted(queried) != sorted(failed):
+            errors.append(f'{len(queried)} hashes were queried again instead of the {len(failed)} failed')
+        server.shutdown()
+
+    if errors:
+        print(*errors, sep='\n')
+        sys.exit(1)
+    print(f'OK: {len(hashes)} torrents, {len(failed)} without a key, all requests at least {MIN_GAP} sec apart')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-n', '--num', type=int, default=NUM_TORRENTS, help='the number of stand-in torrents')
+    parser.add_argument('-j', '--jobs', type=int, default=2, help='the number of processes to parse torrents')
+    main(parser.parse_args())
@@ -1,33 +1,177 @@
+import os
+import argparse
 from re import match
-from time import sleep
+from json import loads, dumps
+from time import monotonic, sleep
 from pathlib import Path
+from threading import Lock
+from functools import partial
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, wait, FIRST_COMPLETED
 
 import requests                         # python3 -m pip install requests
-from more_itertools import chunked      # python3 -m pip install more-itertools
+from requests.adapters import HTTPAdapter
 
-from tu import fromTorrent              # https://raw.githubusercontent.com/airium/TorrentUtils/master/tu.py
+try:
+    from tu import fromTorrent          # https://raw.githubusercontent.com/airium/TorrentUtils/master/tu.py
+except ImportError:
+    fromTorrent = None                  # a stand-in can be passed to main() instead, see testUpdU2SecKey.py
 
 # config
 DIR4TORRENTS = Path()
 U2API_URL = ''
+KEY_CACHE = Path(__file__).with_name(Path(__file__).stem + '_keys.json')
+# infohash -> key of the torrents already updated, saved after each batch so an interrupted run resumes from there
+# torrents whose announce url already holds the cached key are skipped, use '-r' after resetting the passkey
+BATCH_SIZE = 100                        # max 100 entries per request
+MIN_INTERVAL = 2.2                      # minimum 2 sec between requests, plus some margin
+MAX_IN_FLIGHT = 2                       # the number of requests waiting for response at the same time
+RETRIES = 3                             # retry a failed request with backoff before giving up
+RETRY_STATUS = (429, 500, 502, 503, 504)
+ANNOUNCE = 'https://tracker.dmhy.org/announce?secure={}'
 
-# sanity check
-assert DIR4TORRENTS.is_dir(), f'Error: {DIR4TORRENTS} not exists'
-assert match(r'https://u2\.dmhy.org/jsonrpc_torrentkey\.php\?apikey=[0-9a-f]{64}', U2API_URL)
-
-# start
-paths2torrent = list(DIR4TORRENTS.glob('*.torrent'))
-torrents = list(map(fromTorrent, paths2torrent))
-req = []
-for i, t in enumerate(torrents, start=1):
-    req.append({"jsonrpc": "2.0", "method": "query", "params": [ t.hash ], "id": i})
-res = []
-for c in chunked(req, 100): # max 100 entries per request
-    res += requests.post(U2API_URL, json=c).json()
-    sleep(3) # minimum 2 sec between requests
-for r, t, p in zip(res, torrents, paths2torrent):
-    if key := r.get('result'):
-        t.announce = f'https://tracker.dmhy.org/announce?secure={key}'
-        t.write(p, overwrite=True)
-    else:
-        print(f'Error: {p.name} {r.get("error").get("code")} {r.get("error").get("message")}')
+
+class TokenBucket():
+    # allow `capacity` requests at once and refill a token every `interval` sec, blocking until one is available
+    # the default capacity of 1 makes it a plain minimum interval between requests, as required by the api
+
+    def __init__(self, interval: float, capacity: int = 1):
+        self.interval = interval
+        self.capacity = capacity
+        self.tokens = capacity
+        self.time = monotonic()
+        self.lock = Lock()
+
+    def take(self):
+        with self.lock:
+            now = monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.time) / self.interval)
+            self.time = now
+            if self.tokens < 1:
+                sleep((1 - self.tokens) * self.interval)
+                self.tokens, self.time = 1, monotonic()
+            self.tokens -= 1
+
+
+def probe(path: Path, load=fromTorrent) -> tuple:
+    # the infohash and the announce url of a torrent, or None if it cannot be parsed
+    # `load` reads a torrent like tu.fromTorrent, it must be picklable as it is called in the process pool
+    try:
+        t = load(path)
+        return t.hash, t.announce
+    except Exception:
+        return None
+
+
+def update(path: Path, key: str, load=fromTorrent):
+    t = load(path)
+    t.announce = ANNOUNCE.format(key)
+    t.write(path, overwrite=True)
+
+
+def boundedMap(executor, fn, items, window: int):
+    # like executor.map, but only submit `window` tasks ahead of the consumer so that results do not pile up
+    futures = deque()
+    for item in items:
+        futures.append(executor.submit(fn, item))
+        if len(futures) >= window:
+            yield futures.popleft().result()
+    while futures:
+        yield futures.popleft().result()
+
+
+def query(session: requests.Session, bucket: TokenBucket, url: str, hashes: list) -> dict:
+    # return the responses by id, i.e. the index (from 1) of the hash, as a batch response may come in any order
+    # and may miss entries, while an error without a valid id (e.g. a parse error) cannot belong to any hash
+    # a failed request is retried here rather than by urllib3, so that every attempt waits for the bucket
+    batch = [{"jsonrpc": "2.0", "method": "query", "params": [h], "id": i} for i, h in enumerate(hashes, start=1)]
+    for attempt in range(RETRIES + 1):
+        if attempt:
+            sleep(MIN_INTERVAL * 2 ** (attempt - 1))       # back off on top of the minimum interval
+        bucket.take()
+        try:
+            res = session.post(url, json=batch)
+        except (requests.ConnectionError, requests.Timeout):
+            if attempt < RETRIES:
+                continue
+            raise
+        if res.status_code in RETRY_STATUS and attempt < RETRIES:
+            continue
+        res.raise_for_status()
+        return {r['id']: r for r in res.json() if isinstance(r.get('id'), int)}
+
+
+def saveCache(cache: dict):
+    (tmp := KEY_CACHE.with_suffix('.tmp')).write_text(dumps(cache), encoding='utf-8')
+    os.replace(tmp, KEY_CACHE)                              # never leave a broken checkpoint
+
+
+def main(args, load=fromTorrent):
+
+    # sanity check
+    assert load, 'Error: tu.py is required to parse torrents'
+    assert args.dir.is_dir(), f'Error: {args.dir} not exists'
+    assert match(r'https://u2\.dmhy\.org/jsonrpc_torrentkey\.php\?apikey=[0-9a-f]{64}'
+                 r'|http://(localhost|127\.0\.0\.1)[:/]', args.url)   # or a local stand-in for testing
+
+    cache = loads(KEY_CACHE.read_bytes()) if KEY_CACHE.is_file() and not args.reset else {}
+    session = requests.Session()                            # keep the connection alive between requests
+    session.mount('https://', HTTPAdapter(pool_maxsize=MAX_IN_FLIGHT))  # retried by query() instead
+    session.mount('http://', HTTPAdapter(pool_maxsize=MAX_IN_FLIGHT))
+    bucket = TokenBucket(MIN_INTERVAL)
+
+    # start
+    # torrents are parsed in the pool while earlier batches are in flight, and rewritten in the pool once answered
+    with ProcessPoolExecutor(args.jobs) as pool, ThreadPoolExecutor(MAX_IN_FLIGHT) as sender:
+        sent = {}                                           # future -> [(path, infohash)]
+
+        def apply(future):
+            batch = sent.pop(future)
+            writes = []
+            res = future.result()
+            for i, (p, h) in enumerate(batch, start=1):
+                if not (r := res.get(i)):
+                    print(f'Error: {p.name} no response')
+                elif key := r.get('result'):
+                    writes.append((pool.submit(update, p, key, load), h, key))
+                else:
+                    err = r.get('error') or {}
+                    print(f'Error: {p.name} {err.get("code")} {err.get("message")}')
+            for w, h, key in writes:
+                w.result()
+                cache[h] = key
+            saveCache(cache)
+
+        def send(batch):
+            if len(sent) >= MAX_IN_FLIGHT:
+                for future in wait(sent, return_when=FIRST_COMPLETED).done:
+                    apply(future)
+            sent[sender.submit(query, session, bucket, args.url, [h for _, h in batch])] = batch
+
+        paths2torrent = sorted(args.dir.glob('*.torrent'))
+        batch, rewrites = [], []
+        for p, info in zip(paths2torrent, boundedMap(pool, partial(probe, load=load), paths2torrent,
+                                                     BATCH_SIZE * (MAX_IN_FLIGHT + 1))):
+            if not info:
+                print(f'Error: {p.name} cannot be parsed')
+            elif key := cache.get(info[0]):                 # the key is known, no need to query
+                if info[1] != ANNOUNCE.format(key):
+                    rewrites.append(pool.submit(update, p, key, load))
+            elif len(batch := batch + [(p, info[0])]) == BATCH_SIZE:
+                send(batch)
+                batch = []
+        if batch:
+            send(batch)
+        for future in list(sent):
+            apply(future)
+        for w in rewrites:
+            w.result()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('dir', type=Path, nargs='?', default=DIR4TORRENTS, help='the dir of torrents to update')
+    parser.add_argument('-u', '--url', default=U2API_URL, help='the api url with your apikey')
+    parser.add_argument('-j', '--jobs', type=int, default=os.cpu_count(), help='the number of processes to parse torrents')
+    parser.add_argument('-r', '--reset', action='store_true', help='ignore the cached keys, e.g. after resetting passkey')
+    main(parser.parse_args())